@@ -18,6 +18,10 @@ Author:
 
 Usage:
   affine.py [-a AKEY] [-b BKEY] [-d] <cyphertext>...
+  affine.py [-a AKEY] [-b BKEY] [-d] --input FILE [--output FILE]
+  affine.py --auto [--top K] <cyphertext>...
+  affine.py --auto [--top K] --input FILE
+  affine.py --test
   affine.py (-h | --help)
   affine.py --version
 
@@ -28,28 +32,29 @@ Options:
                 'a' must be both less than and coprime to 26.
   -b=<bkey>     Number of Characters to rotate cyphertext [default: 13].
   -d            Use the decypher algorithm instead of the encypher algorithm.
+  --input=<file>   Stream text from file ('-' for stdin) in chunks instead of
+                   reading it from the command line.
+  --output=<file>  Write streamed text to file instead of stdout.
+  --auto        Break the cypher: rank all 312 (A, B) keys by how closely the
+                decyphered letter frequencies match English.
+  --top=<k>     Number of best keys to show with --auto [default: 5].
+  --test        Run the tests for this file.
 
 """
 from __future__ import print_function
 from docopt import docopt
-import string
-VERSION='1.0'
-DATE='2014-05-09'
+import numpy
+from cypher_tables import ALLOWED_A_VALUES, affine_table, transform_file, \
+  transform_words
+import frequencies
+VERSION='1.1'
+DATE='2026-10-18'
 TITLE='Affine'
-ALLOWED_A_VALUES=[1,3,5,7,9,11,15,17,19,21,23,25]
-INVERSE_A={
-   1 : 1  ,  
-   3 : 9  ,  
-   5 : 21 ,
-   7 : 15 ,
-   9 : 3  ,
-  11 : 19 ,
-  15 : 7  ,
-  17 : 23 ,
-  19 : 11 ,
-  21 : 5  ,
-  23 : 17 ,
-  25 : 25 , }
+AFFINE_KEYS = [(a, b) for a in ALLOWED_A_VALUES for b in range(26)]
+# KEY_PERMUTATIONS[k][p] is the cypher letter that plain letter p becomes
+# under AFFINE_KEYS[k]
+KEY_PERMUTATIONS = numpy.array([[(p * a + b) % 26 for p in range(26)]
+  for (a, b) in AFFINE_KEYS])
 
 
 def affine(words, a, b, decypher=False):
@@ -63,47 +68,57 @@ def affine(words, a, b, decypher=False):
     return
 
 
+def affine_auto(words, top=5):
+    '''Print the top best scoring keys for decyphering words.'''
+    cypher_text = ' '.join(words)
+    ranked_keys = rank_affine_keys(frequencies.letter_histogram(cypher_text))
+    for ii, (score, a, b) in enumerate(ranked_keys[:top]):
+        (cypher_text, clear_text) = affine_(words, a, b, decypher=True)
+        prettyprint_affine(cypher_text, a, b, clear_text, decypher=True,
+          header=(ii == 0), score=score)
+    return ranked_keys[:top]
+
+
+def rank_affine_keys(histogram):
+    """Rank every affine key by English fitness of a cyphertext histogram.
+
+    Decyphering only relabels letters, so the plaintext histogram for each key
+    is a permutation of the cyphertext histogram.  All 312 keys are scored
+    with chi-squared against English letter frequencies in one array
+    operation, without decyphering the text.
+
+    Returns a list of (score, a, b) sorted best (lowest score) first."""
+    histogram = numpy.asarray(histogram, dtype=float)
+    scores = frequencies.chi_squared(histogram[KEY_PERMUTATIONS]) # 312 keys
+    return [(scores[k],) + AFFINE_KEYS[k] for k in numpy.argsort(scores,
+      kind='mergesort')]
+
+
 def affine_(words, a, b, decypher=False):
-    if decypher:
-        a = INVERSE_A[a]
-        f = affine_decode
-    else:
-        f = affine_encode
-    clear_text = ""
-    cypher_text = ""
-    for cypher in words:
-        cypher_text += cypher
-        cypher = cypher.upper()
-        for c in cypher:
-            if not c in string.ascii_letters:
-                clear_text += c
-                continue
-            new_c = f(a, b, c)
-            #print(c, ' -> ', new_c)
-            clear_text = ''.join([clear_text, new_c])
-        clear_text += ' '
-        cypher_text += ' '
-    return cypher_text, clear_text
-
-
-def affine_decode(a, b, char):
-    return chr(((ord(char) - 65 - b ) * a ) % 26 + 65 )
-
-
-def affine_encode(a, b, char):
-    return chr(((ord(char) - 65) * a + b ) % 26 + 65 )
+    return transform_words(words, affine_table(a, b, decypher))
 
 
 def prettyprint_affine(cypher_text, a, b, clear_text, decypher=False,
-  header=True):
+  header=True, score=None):
     operation = "DE-AFFINE" if decypher else "AFFINE"
     spaces = " " * ( len(operation) + 4 )
     if header:
         print("INPUT:%s"%spaces, cypher_text)
+    if score is not None:
+        print("%s(%2d,%-2d):  "%(operation, a, b), clear_text,
+          " chi2=%.1f"%score)
+        return
     print("%s(%2d,%-2d):  "%(operation, a, b), clear_text)
     return
 
 
+def prettyprint_keys(ranked_keys):
+    print("  A   B    CHI2")
+    for (score, a, b) in ranked_keys:
+        print("%3d  %2d  %6.1f"%(a, b, score))
+    return
+
+
 def check_inputs(args):
     passed = True
     if int(args['-a'].strip('=')) not in ALLOWED_A_VALUES:
@@ -112,11 +127,68 @@ def check_inputs(args):
     if int(args['-b'].strip('=')) not in range(26):
         print("ERROR: B not in %s"%range(26))
         passed = False
+    if args['--input'] and int(args['-b'].strip('=')) == 0:
+        print("ERROR: B must be specified when streaming with --input")
+        passed = False
     return passed
 
 
+# =============================================================================
+# TESTS
+# =============================================================================
+def test_rank_affine_keys():
+    '''Test function rank_affine_keys() against decyphering with every key.'''
+    clear_text = "It was the best of times, it was the worst of times, it " \
+      "was the age of wisdom, it was the age of foolishness"
+    cypher_text = affine_([clear_text], 5, 8)[1]
+    ranked_keys = rank_affine_keys(frequencies.letter_histogram(cypher_text))
+    if ranked_keys[0][1:] != (5, 8) or len(ranked_keys) != len(AFFINE_KEYS):
+        return False # failed
+    for (score, a, b) in ranked_keys:
+        decyphered = affine_([cypher_text], a, b, decypher=True)[1]
+        expected = frequencies.chi_squared(frequencies.letter_histogram(
+          decyphered))
+        if not numpy.isclose(score, expected):
+            return False # failed
+    return True # passed
+
+
+def run_tests():
+    '''Run all tests for this file.'''
+    result = "passed" # start assuming tests will pass
+    print("\n"+15*'=', "Testing module %s" % __file__, 15*'=')
+    tests = [
+      (test_rank_affine_keys(), "Test rank_affine_keys:"),
+      ]
+    for test in tests:
+        this_result = "passed" if test[0] else "failed"
+        print("%-46s"%test[1], this_result)
+        if not test[0]:
+            result = "failed"
+
+    if result != "passed":
+        print(15*'=',"Result: One or more tests failed.", 15*'=')
+        return False # failed one or more tests
+    print(15*'=', "Result: All tests passed.", 15*'=')
+    return True # passed all tests
+
+
 if __name__ == '__main__':
     args = docopt(__doc__, version='%s %s:%s'%(TITLE, VERSION, DATE))
-    if check_inputs(args):
-        affine(args['<cyphertext>'], int(args['-a'].strip('=')), 
-          int(args['-b'].strip('=')), args['-d'])
+    if args['--test']:
+        result = run_tests()
+    elif args['--auto']:
+        top = int(args['--top'])
+        if args['--input']:
+            histogram = frequencies.letter_histogram_file(args['--input'])
+            prettyprint_keys(rank_affine_keys(histogram)[:top])
+        else:
+            affine_auto(args['<cyphertext>'], top)
+    elif check_inputs(args):
+        a = int(args['-a'].strip('='))
+        b = int(args['-b'].strip('='))
+        if args['--input']:
+            transform_file(args['--input'], args['--output'],
+              affine_table(a, b, args['-d'], binary=True))
+        else:
+            affine(args['<cyphertext>'], a, b, args['-d'])
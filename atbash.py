@@ -9,23 +9,31 @@ Author:
 
 Usage:
   atbash.py <cyphertext>...
+  atbash.py --input FILE [--output FILE]
   atbash.py (-h | --help)
   atbash.py --version
 
 Options:
   -h --help     Show this screen.
   --version     Show version.
+  --input=<file>   Stream text from file ('-' for stdin) in chunks instead of
+                   reading it from the command line.
+  --output=<file>  Write streamed text to file instead of stdout.
 
 """
 from __future__ import print_function
 from docopt import docopt
-import string
-VERSION='1.1'
-DATE='2015-09-19'
+from cypher_tables import atbash_table, transform_file, transform_words
+VERSION='1.2'
+DATE='2026-10-18'
 TITLE='Altbash'
 
 
 def main(args):
+    if args['--input']:
+        transform_file(args['--input'], args['--output'],
+          atbash_table(binary=True))
+        return
     (cypher_text, clear_text) = altbash_encode(args['<cyphertext>'])
     print("INPUT:    ", cypher_text)
     print("ALTBASH:  ", clear_text)
@@ -33,22 +41,7 @@ def main(args):
 
 
 def altbash_encode(words):
-    clear_text = ""
-    cypher_text = ""
-    for cypher in words:
-        cypher_text += cypher
-        cypher = cypher.upper()
-        for c in cypher:
-            if not c in string.ascii_letters:
-                clear_text += c
-                continue
-            # A = 65, Z = 90
-            new_c = chr( (90 - (ord(c) - 65)) )
-            #print(c, ' -> ', new_c)
-            clear_text = ''.join([clear_text, new_c])
-        clear_text += ' '
-        cypher_text += ' '
-    return (cypher_text, clear_text)
+    return transform_words(words, atbash_table())
 
 
 if __name__ == '__main__':
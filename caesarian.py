@@ -9,6 +9,10 @@ Author:
 
 Usage:
   caesarian.py [--rot ROT] <cyphertext>...
+  caesarian.py [--rot ROT] --input FILE [--output FILE]
+  caesarian.py --auto [--top N] <cyphertext>...
+  caesarian.py --auto [--top N] --input FILE
+  caesarian.py --test
   caesarian.py (-h | --help)
   caesarian.py --version
 
@@ -16,6 +20,13 @@ Options:
   -h --help     Show this screen.
   --version     Show version.
   --rot=<rot>   Number of Characters to rotate cyphertext [default: 13].
+  --input=<file>   Stream text from file ('-' for stdin) in chunks instead of
+                   reading it from the command line.
+  --output=<file>  Write streamed text to file instead of stdout.
+  --auto        Break the cypher: score every ROT against English letter
+                frequencies and show only the best.
+  --top=<n>     Number of best ROTs to show with --auto [default: 3].
+  --test        Run the tests for this file.
 
 Notes:
   Used to solve http://decodeingress.me/category/code-breaking-101/
@@ -23,13 +34,27 @@ Notes:
 """
 from __future__ import print_function
 from docopt import docopt
-import string
-VERSION='1.0'
-DATE='2014-05-06'
+import numpy
+from cypher_tables import rot_table, transform_file, transform_words
+import frequencies
+VERSION='1.1'
+DATE='2026-10-18'
 TITLE='Caesarian'
+SHIFTS = numpy.arange(1, 26, dtype=numpy.uint8)
+SAMPLE_SIZE = 256       # letters scored before the first early exit check
+MAX_BLOCK_SIZE = 65536  # letters shifted at once, bounds the (25, n) array
+CLEAR_WIN_RATIO = 3.0   # runner up chi2 / best chi2 needed to stop early
 
 def caesarian(args):
-    if args['--rot'] == 0:
+    if args['--auto']:
+        caesarian_auto(args)
+    elif args['--input']:
+        if args['--rot'] == 0:
+            print("ERROR: ROT must be specified when streaming with --input")
+            return
+        transform_file(args['--input'], args['--output'],
+          rot_table(args['--rot'], binary=True))
+    elif args['--rot'] == 0:
         for rot in range(1,26):
             (cypher_text, clear_text) = rot_encode(args['<cyphertext>'], rot)
             if rot == 1:
@@ -43,25 +68,176 @@ def caesarian(args):
     return
 
 
+def caesarian_auto(args):
+    top = int(args['--top'])
+    if args['--input']:
+        ranked_rots, scored = rank_rots(letter_blocks(
+          frequencies.letter_indexes_file(args['--input'])))
+        print("ROT  CHI2   (scored %d letters)"%scored)
+        for (score, rot) in ranked_rots[:top]:
+            print("%02d  %6.1f"%(rot, score))
+        return
+    words = args['<cyphertext>']
+    letters = frequencies.letter_indexes(' '.join(words))
+    ranked_rots, scored = rank_rots(letter_blocks([letters]))
+    for ii, (score, rot) in enumerate(ranked_rots[:top]):
+        (cypher_text, clear_text) = rot_encode(words, rot)
+        if ii == 0:
+            print("INPUT:  ", cypher_text)
+        print("ROT%02d:  "%rot, clear_text, " chi2=%.1f"%score)
+    print("(scored %d of %d letters)"%(scored, len(letters)))
+    return
+
+
+def letter_blocks(chunks, sample_size=SAMPLE_SIZE):
+    '''Re-split letter arrays into blocks that double in size.'''
+    size = sample_size
+    for letters in chunks:
+        start = 0
+        while start < len(letters):
+            yield letters[start:start + size]
+            start += size
+            size = min(size * 2, MAX_BLOCK_SIZE)
+
+
+def rank_rots(blocks, clear_win_ratio=CLEAR_WIN_RATIO):
+    """Score all 25 ROTs of a stream of letter index arrays.
+
+    Each block is shifted by every ROT at once as a (25, n) array and the
+    per-ROT letter counts are accumulated.  After each block the ROTs are
+    scored with chi-squared against English; once the runner up is at least
+    clear_win_ratio times worse than the best, the remaining blocks are
+    skipped.
+
+    Returns ([(score, rot), ...] best first, number of letters scored)."""
+    counts = numpy.zeros((len(SHIFTS), 26))
+    offsets = (numpy.arange(len(SHIFTS), dtype=numpy.uint16) * 26)[:, None]
+    scored = 0
+    for block in blocks:
+        for start in range(0, len(block), MAX_BLOCK_SIZE):
+            sub_block = block[start:start + MAX_BLOCK_SIZE]
+            shifted = (sub_block[None, :] + SHIFTS[:, None]) % 26
+            counts += numpy.bincount((shifted + offsets).ravel(),
+              minlength=counts.size).reshape(counts.shape)
+        scored += len(block)
+        scores = frequencies.chi_squared(counts)
+        order = numpy.argsort(scores, kind='mergesort')
+        if scores[order[1]] >= clear_win_ratio * scores[order[0]]:
+            break # one ROT clearly wins
+    if scored == 0:
+        scores = numpy.zeros(len(SHIFTS))
+        order = numpy.arange(len(SHIFTS))
+    return [(scores[ii], int(SHIFTS[ii])) for ii in order], scored
+
+
 def rot_encode(words, rot):
-    clear_text = ""
-    cypher_text = ""
-    for cypher in words:
-        cypher_text += cypher
-        cypher = cypher.upper()
-        for c in cypher:
-            if not c in string.ascii_letters:
-                clear_text += c
-                continue
-            new_c = chr((ord(c) - 65 + rot ) % 26 + 65 )
-            #print(c, ' -> ', new_c)
-            clear_text = ''.join([clear_text, new_c])
-        clear_text += ' '
-        cypher_text += ' '
-    return (cypher_text, clear_text)
+    return transform_words(words, rot_table(rot))
+
+
+# =============================================================================
+# TESTS
+# =============================================================================
+TEST_TEXT = "It was the best of times, it was the worst of times, it was the " \
+  "age of wisdom, it was the age of foolishness"
+
+
+def brute_force_rots(letters):
+    '''Chi-squared of every ROT of letters, decrypting each one in turn.'''
+    return [(frequencies.chi_squared(numpy.bincount((letters + rot) % 26,
+      minlength=26)), rot) for rot in range(1, 26)]
+
+
+def test_rank_rots():
+    '''Test function rank_rots() against a brute force search.'''
+    cypher_text = rot_encode([TEST_TEXT], 19)[1]
+    letters = frequencies.letter_indexes(cypher_text)
+    ranked_rots, scored = rank_rots(letter_blocks([letters]))
+    if ranked_rots[0][1] != 7 or scored != len(letters):
+        return False # failed
+    expected = sorted(brute_force_rots(letters), key=lambda pair: pair[0])
+    if [rot for _, rot in ranked_rots] != [rot for _, rot in expected]:
+        return False # failed
+    if not numpy.allclose([score for score, _ in ranked_rots],
+      [score for score, _ in expected]):
+        return False # failed
+    return True # passed
+
+
+def test_rank_rots_early_exit():
+    '''Test that rank_rots() stops once one ROT clearly wins.'''
+    letters = frequencies.letter_indexes(rot_encode([TEST_TEXT * 100], 19)[1])
+    ranked_rots, scored = rank_rots(letter_blocks([letters]))
+    if ranked_rots[0][1] != 7 or not 0 < scored < len(letters):
+        return False # failed
+    return True # passed
+
+
+def test_letter_blocks():
+    '''Test that letter_blocks() doubles the block size up to the maximum.'''
+    letters = numpy.zeros(2000, numpy.uint8)
+    sizes = [len(block) for block in letter_blocks([letters[:700],
+      letters[700:]])]
+    if sizes != [256, 444, 1024, 276]:
+        return False # failed
+    sizes = [len(block) for block in letter_blocks([numpy.zeros(
+      MAX_BLOCK_SIZE * 3, numpy.uint8)], MAX_BLOCK_SIZE // 2)]
+    if sizes != [MAX_BLOCK_SIZE // 2] + [MAX_BLOCK_SIZE] * 2 + \
+      [MAX_BLOCK_SIZE // 2]:
+        return False # failed
+    return True # passed
+
+
+def test_rank_rots_large_block():
+    '''Test rank_rots() on a block split into MAX_BLOCK_SIZE sub-blocks.'''
+    letters = numpy.random.RandomState(1).randint(0, 26,
+      MAX_BLOCK_SIZE + 1000).astype(numpy.uint8)
+    ranked_rots, scored = rank_rots([letters], clear_win_ratio=numpy.inf)
+    expected = dict([(rot, score) for score, rot in brute_force_rots(letters)])
+    if scored != len(letters) or len(ranked_rots) != 25:
+        return False # failed
+    for score, rot in ranked_rots:
+        if not numpy.isclose(score, expected[rot]):
+            return False # failed
+    return True # passed
+
+
+def test_rank_rots_empty():
+    '''Test function rank_rots() with no letters.'''
+    ranked_rots, scored = rank_rots(letter_blocks([numpy.zeros(0,
+      numpy.uint8)]))
+    if scored != 0 or ranked_rots != [(0.0, rot) for rot in range(1, 26)]:
+        return False # failed
+    return True # passed
+
+
+def run_tests():
+    '''Run all tests for this file.'''
+    result = "passed" # start assuming tests will pass
+    print("\n"+15*'=', "Testing module %s" % __file__, 15*'=')
+    tests = [
+      (test_rank_rots(), "Test rank_rots:"),
+      (test_rank_rots_early_exit(), "Test rank_rots early exit:"),
+      (test_letter_blocks(), "Test letter_blocks:"),
+      (test_rank_rots_large_block(), "Test rank_rots with MAX_BLOCK_SIZE:"),
+      (test_rank_rots_empty(), "Test rank_rots without letters:"),
+      ]
+    for test in tests:
+        this_result = "passed" if test[0] else "failed"
+        print("%-46s"%test[1], this_result)
+        if not test[0]:
+            result = "failed"
+
+    if result != "passed":
+        print(15*'=',"Result: One or more tests failed.", 15*'=')
+        return False # failed one or more tests
+    print(15*'=', "Result: All tests passed.", 15*'=')
+    return True # passed all tests
 
 
 if __name__ == '__main__':
     args = docopt(__doc__, version='%s %s:%s'%(TITLE, VERSION, DATE))
-    args['--rot'] = int(args['--rot'])
-    caesarian(args)
+    if args['--test']:
+        result = run_tests()
+    else:
+        args['--rot'] = int(args['--rot'])
+        caesarian(args)
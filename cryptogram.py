@@ -10,8 +10,12 @@ Author:
 Usage:
   cryptogram.py analyze <cyphertext>...
   cryptogram.py analyze -i <cyphertext>...
-  cryptogram.py sub -f <file> <cyphertext>...
-  cryptogram.py sub -i -f <file> <cyphertext>...
+  cryptogram.py analyze [-i] [-p <processes>] --batch <file>
+  cryptogram.py sub [--format <format>] [--watch] -f <file> <cyphertext>...
+  cryptogram.py sub -i [--format <format>] [--watch] -f <file> <cyphertext>...
+  cryptogram.py solve [-w <wordlist>]... <cyphertext>...
+  cryptogram.py anneal [-i] [-t <seconds>] [-c <corpus> | -m <model>] <cyphertext>...
+  cryptogram.py test
   cryptogram.py <cyphertext>...
   cryptogram.py -i <cyphertext>...
   cryptogram.py (-h | --help)
@@ -22,16 +26,40 @@ Options:
   --version     Show version.
   -i            Ignore spaces. Use this when spaces are not provided between words.
   -f <file>     File containing guess mapping of cypherchar to plainchar.
+  --batch <file>  Analyze one cyphertext per line of file ('-' for stdin),
+                printing one JSON result per line in input order.  Lines may
+                be JSON records with a "cyphertext" field (and optional "id").
+                Each result carries its input "line" number; lines that are
+                blank or fail to analyze give an "error" instead.
+  -p <processes>  Number of worker processes for --batch (default: one per
+                core).
+  --format <format>  Substitution output: color, plain, json or auto (color
+                when writing to a terminal, plain otherwise) [default: auto].
+  --watch       Keep running and redraw the substitution each time the guess
+                file is saved.  Stop with Ctrl-C.
+  -w <wordlist>  Extra words file for solve (e.g. names or jargon), one word
+                per line with an optional count.  May be repeated.  Set
+                CRYPTO_WORD_FREQUENCIES to a file of "word count" lines to
+                rank the main words list too.
+  -t <seconds>  Time budget for anneal [default: 10].
+  -c <corpus>   Plain text file used to build the quadgram model for anneal.
+  -m <model>    Quadgram model file saved by frequencies.build_quadgram_model
+                (default: quadgrams.npy next to frequencies.py).  The words
+                list is used if there is no model or corpus.
+
+Commands:
+  analyze       Print letter, double, sequence and vowel statistics.
+  sub           Apply the guess file to the cyphertext.
+  solve         Search the words list for a mapping that turns every cypher
+                word into an English word.  Needs spaces between words.
+  anneal        Search for the key whose plaintext has the most English
+                looking quadgrams.  Works without spaces between words.
 
 """
 from __future__ import print_function
 """
 Additional features to implement: 
     IMPLEMENT WORD BOUNDARY ANALYSIS
-        Look for words / Autosolve
-          Create a map of word character patterns: e.g. workout = ABCDAFG
-          Use words file. Algorithm: apply letter maps, count #words in solution.
-          Display the solutions containing the most words
         Look for prefixes
           {ex-, over-, un-, or up-}
         Look for suffexes
@@ -51,12 +79,33 @@ source of strategies:
 """
 from docopt import docopt
 import string
-from termcolor import colored, cprint
+from termcolor import colored
 import re
+import json
+import sys
+import math
+import os
+import functools
+import multiprocessing
+import random
+import time
+import collections
+import numpy
+from cypher_tables import substitution_table
+import frequencies
 
-VERSION='1.1'
-DATE='2014-05-09'
+VERSION='1.2'
+DATE='2026-10-18'
 NAME='Cryptogram'
+SOLVE_MAX_NODES = 20000 # search nodes visited before giving up
+SEQUENCE_SIZES = (2, 3, 4) # lengths of the character sequences counted
+WATCH_INTERVAL = 0.1       # seconds between guess file checks with --watch
+LINE_WIDTH = 80            # characters per line of wrapped text
+CLEAR_SCREEN = '\x1b[H\x1b[2J'
+BATCH_CHUNKSIZE = 64       # cyphertexts handed to a --batch worker at a time
+ANNEAL_NGRAM_SIZE = 4       # anneal scores plaintext quadgrams
+ANNEAL_STEPS = 4000         # key swaps tried per anneal restart
+ANNEAL_TEMPERATURE = 0.5    # starting temperature, falls linearly to 0
 
 
 
@@ -68,111 +117,683 @@ def substitute(args):
         lowercase green is CYPHERTEXT """
     # BUILD & PRINT CYPHERTEXT
     cyphertext = build_cyphertext(args)
-    prettyprint_text('INPUT TEXT', cyphertext)
+    style = args['--format']
+    if args['--watch']:
+        watch_substitution(cyphertext, args['-f'], style)
+        return
+    if style != 'json':
+        prettyprint_text('INPUT TEXT', cyphertext)
 
     filename = args['-f']
     decodes = read_guess_file(filename)
+    print_substitution(cyphertext, decodes, style)
+    return
+
+
+def print_substitution(cyphertext, decodes, style='auto'):
+    """Print cyphertext with the decodes mapping applied.
+
+    The whole substitution is written at once; see render_substitution()."""
+    if style == 'auto':
+        style = 'color' if sys.stdout.isatty() else 'plain'
+    if style == 'json':
+        print(render_substitution(cyphertext, decodes, style))
+        return
+    sys.stdout.write("\n%s\n\n"%render_substitution(cyphertext, decodes,
+      style))
+    sys.stdout.flush()
+    return
+
+
+def render_substitution(cyphertext, decodes, style='color'):
+    """Apply the decodes mapping to cyphertext in a single translate pass.
 
-    # PERFORM SUBSTITUTION
-    print("")
-    for c in cyphertext:
-        if c in decodes.keys():
-            cprint(decodes[c], 'blue', attrs=['bold'], end="")
+    Cypherchars without a decode are shown in lowercase.  The style is
+      color: decoded runs bold blue, the rest underlined green on grey, with
+             one pair of escape codes per run of same-style characters
+      plain: no escape codes
+      json:  a JSON object with the cyphertext, plaintext and decodes"""
+    undecoded = dict([(c, c.lower()) for c in string.ascii_uppercase
+      if c not in decodes])
+    undecoded.update(decodes)
+    plaintext = cyphertext.translate(substitution_table(undecoded))
+    if style == 'plain':
+        return plaintext
+    if style == 'json':
+        return json.dumps({'cyphertext' : cyphertext, 'plaintext' : plaintext,
+          'decodes' : decodes}, sort_keys=True)
+    if not decodes:
+        return colored(plaintext, 'green', 'on_grey', attrs=['underline'])
+    decoded_chars = ''.join([re.escape(c) for c in sorted(decodes)])
+    runs = re.compile('([%s]+)|[^%s]+'%(decoded_chars, decoded_chars))
+    text = []
+    for run in runs.finditer(cyphertext):
+        if run.group(1):
+            text.append(colored(plaintext[run.start():run.end()], 'blue',
+              attrs=['bold']))
         else:
-            if c in string.uppercase:
-                c = c.lower()
-            cprint(c, 'green', 'on_grey', attrs=['underline'], end="")
-    print("\n")
+            text.append(colored(plaintext[run.start():run.end()], 'green',
+              'on_grey', attrs=['underline']))
+    return ''.join(text)
+
+
+def watch_substitution(cyphertext, filename, style='auto',
+  interval=WATCH_INTERVAL):
+    """Redraw the substitution whenever the guess file changes.
 
+    The cyphertext and its SubstitutionView stay in memory between edits, so
+    each change re-reads only the small guess file and re-renders only the
+    lines containing a cypherchar whose decode changed."""
+    if style == 'auto':
+        style = 'color' if sys.stdout.isatty() else 'plain'
+    view = SubstitutionView(cyphertext, style)
+    last_stamp = None
+    missing_reported = False
+    try:
+        while True:
+            try:
+                stat = os.stat(filename)
+                # size too: two saves within a coarse mtime tick look alike
+                stamp = (getattr(stat, 'st_mtime_ns', stat.st_mtime),
+                  stat.st_size)
+            except OSError:
+                stamp = None # being replaced by the editor, try again
+                if last_stamp is None and not missing_reported:
+                    print("Waiting for guess file \'%s\' to be created."%
+                      filename)
+                    sys.stdout.flush()
+                    missing_reported = True
+            if stamp is not None and stamp != last_stamp:
+                try:
+                    decodes = read_guess_file(filename)
+                except (IOError, OSError):
+                    time.sleep(interval) # gone again mid-save, retry
+                    continue
+                last_stamp = stamp
+                if style == 'json':
+                    print(render_substitution(cyphertext, decodes, style))
+                else:
+                    view.update(decodes)
+                    if sys.stdout.isatty():
+                        sys.stdout.write(CLEAR_SCREEN)
+                    sys.stdout.write("== SUBSTITUTION (%s) ==\n\n%s\n"%(
+                      filename, view.render()))
+                sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("")
     return
 
 
+class SubstitutionView(object):
+    """Rendered substitution that re-renders only what a change affects.
+
+    The cyphertext is wrapped into lines and each line's rendering is kept.
+    lines_with maps each cypherchar to the lines it appears in, so update()
+    re-renders just the lines holding a cypherchar whose decode changed."""
+
+    def __init__(self, cyphertext, style='color', width=LINE_WIDTH):
+        self.style = style
+        self.lines = [cyphertext[ii:ii + width] for ii in
+          range(0, len(cyphertext), width)]
+        self.lines_with = {}
+        for line_num, line in enumerate(self.lines):
+            for c in set(line):
+                self.lines_with.setdefault(c, []).append(line_num)
+        self.decodes = {}
+        self.rendered = [render_substitution(line, {}, style) for line in
+          self.lines]
+
+    def update(self, decodes):
+        """Switch to new decodes; return the numbers of re-rendered lines."""
+        changed_lines = set()
+        for c in set(self.decodes) | set(decodes):
+            if self.decodes.get(c) != decodes.get(c):
+                changed_lines.update(self.lines_with.get(c, []))
+        for line_num in changed_lines:
+            self.rendered[line_num] = render_substitution(self.lines[line_num],
+              decodes, self.style)
+        self.decodes = dict(decodes)
+        return sorted(changed_lines)
+
+    def render(self):
+        """Return each cyphertext line above its substitution."""
+        return ''.join(["%s\n%s\n\n"%(line, rendered) for line, rendered in
+          zip(self.lines, self.rendered)])
+
+
 def read_guess_file(filename):
     """ This Function parses the guess file """
     is_decode = re.compile("^\s*(?P<cypher>[a-zA-Z])\s*=\s*(?P<clear>[a-zA-Z])[\s$#]")
     decodes = {}
-    fd = open(filename, 'r')
-    for line in fd:
-        m = is_decode.search(line)
-        if not m:
-            continue
-        #print(line, m.group('cypher'), m.group('clear'))
-        if m.group('cypher') in decodes.keys():
-            print("WARNING: Cypherchar \'%s\'"%m.group('cypher'), " specified multiple times in guess file - using last occurance.")
-        decodes[m.group('cypher')] = m.group('clear')
+    with open(filename, 'r') as fd:
+        for line in fd:
+            m = is_decode.search(line)
+            if not m:
+                continue
+            #print(line, m.group('cypher'), m.group('clear'))
+            if m.group('cypher') in decodes.keys():
+                print("WARNING: Cypherchar \'%s\'"%m.group('cypher'), " specified multiple times in guess file - using last occurance.")
+            decodes[m.group('cypher')] = m.group('clear')
     return decodes
 
 
+def solve(args):
+    """This Function searches for a solution and prints it
+
+    The solution is printed as a substitution followed by a guess file that
+    can be edited and used with the sub command."""
+    cyphertext = build_cyphertext(args)
+    prettyprint_text('INPUT TEXT', cyphertext)
+
+    wordlists = None
+    if args['-w']:
+        wordlists = frequencies.WordLists()
+        wordlists.add(frequencies.default_patterns(),
+          frequencies.read_word_frequencies(), name='words list')
+        for filename in args['-w']:
+            patterns, counts = frequencies.read_word_list(filename)
+            wordlists.add(patterns, counts, name=filename)
+
+    decodes, unsolved_words = solve_cryptogram(cyphertext, wordlists)
+    print_substitution(cyphertext, decodes)
+    prettyprint_guess_file(cyphertext, decodes)
+    if unsolved_words:
+        print("No words list match for: %s"%' '.join(unsolved_words))
+    return
+
+
+def prettyprint_guess_file(cyphertext, decodes):
+    print("== GUESS FILE ==")
+    for c in string.ascii_uppercase:
+        if c in cyphertext:
+            print("%s = %s"%(c, decodes.get(c, '')))
+    return
+
+
+def solve_cryptogram(cyphertext, patterns=None, max_nodes=SOLVE_MAX_NODES):
+    """Find a letter mapping that turns cypher words into English words.
+
+    Each cypher word is a variable whose candidates are the words list entries
+    with the same pattern, most likely first (patterns may be a
+    frequencies.WordLists; the default is frequencies.default_wordlists()).  A
+    backtracking search assigns the word with the fewest remaining candidates
+    first and, after each assignment, drops every candidate of the other words
+    that conflicts with the partial mapping.
+    Words that can not be matched (proper nouns, words not in the words list)
+    are skipped, trying as few skips as possible.  The search goes on past
+    the first complete mapping until max_nodes are visited, and the mapping
+    whose plaintext letters have the highest mean frequencies.log_likelihood
+    wins.
+
+    Returns (decodes, unsolved_words) where decodes maps uppercase cypherchars
+    to uppercase plainchars."""
+    options = {}
+    indexes = {}
+    unsolved_words = []
+    for word in sorted(set(re.findall('[A-Z]+', cyphertext.upper()))):
+        pattern = frequencies.get_pattern(word)
+        try:
+            indexes[word] = frequencies.get_position_index(pattern, patterns)
+        except KeyError:
+            unsolved_words.append(word) # no words share this pattern
+            continue
+        options[word] = indexes[word].all
+
+    counts = collections.Counter([c for c in cyphertext.upper()
+      if c in string.ascii_uppercase])
+    state = {'nodes' : 0, 'max_nodes' : max_nodes, 'best' : (-1, {}, []),
+      'indexes' : indexes, 'counts' : counts, 'solution' : None}
+    for max_skips in range(len(options) + 1):
+        _solve_search(options, {}, [], max_skips, state)
+        if state['solution'] is not None or state['nodes'] >= max_nodes:
+            break
+    if state['solution'] is not None:
+        mapping, skipped_words = state['solution'][1:]
+    else:
+        mapping, skipped_words = state['best'][1:]
+    decodes = dict([(c, p.upper()) for c, p in mapping.items()])
+    return decodes, sorted(unsolved_words + skipped_words)
+
+
+def _solve_search(options, mapping, skipped, skips_left, state):
+    """Recursive step of solve_cryptogram().
+
+    options maps each unassigned cypher word to the bitset (see
+    frequencies.PositionIndex) of its candidates that are consistent with
+    mapping (cypherchar -> plainchar), and skipped lists the words given up
+    on.  Complete mappings are scored into state['solution'] as (score,
+    mapping, skipped_words).  Returns False once max_nodes are visited."""
+    state['nodes'] += 1
+    if state['nodes'] > state['max_nodes']:
+        return False
+    if len(mapping) > state['best'][0]:
+        state['best'] = (len(mapping), mapping, sorted(skipped + list(options)))
+    if not options:
+        score = _solution_score(mapping, state['counts'])
+        if state['solution'] is None or score > state['solution'][0]:
+            state['solution'] = (score, mapping, sorted(skipped))
+        return True
+    counts = dict([(w, bin(mask).count('1')) for w, mask in options.items()])
+    word = min(options, key=lambda w: (counts[w], -len(w)))
+    if not options[word]:
+        if skips_left == 0:
+            return True
+        rest = dict(options)
+        del rest[word]
+        return _solve_search(rest, mapping, skipped + [word], skips_left - 1,
+          state)
+    indexes = state['indexes']
+    for plain in indexes[word].select(options[word]):
+        new_mapping = dict(mapping)
+        new_pairs = dict([(c, p) for c, p in zip(word, plain)
+          if c not in mapping])
+        new_mapping.update(new_pairs)
+        new_options = {}
+        for other, mask in options.items():
+            if other != word:
+                new_options[other] = _candidate_filter(other, indexes[other],
+                  mask, new_mapping, new_pairs)
+        if not _solve_search(new_options, new_mapping, skipped, skips_left,
+          state):
+            return False
+    return True
+
+
+def _solution_score(mapping, counts):
+    """Mean log10 probability of the plaintext letters mapping gives the
+    cyphertext letter counts."""
+    histogram = numpy.zeros(26)
+    for c, p in mapping.items():
+        histogram[ord(p.upper()) - ord('A')] += counts[c]
+    return frequencies.log_likelihood(histogram) / max(histogram.sum(), 1)
+
+
+def _candidate_filter(word, index, mask, mapping, new_pairs):
+    """Narrow the candidate bitset mask of word after new_pairs were mapped.
+
+    Candidates already share the pattern of word and agree with the rest of
+    mapping, so only the first position of each cypherchar needs checking:
+    newly mapped cypherchars must decode to their plainchar, and the others
+    must not decode to a newly used plainchar."""
+    known = [(word.index(c), p) for c, p in new_pairs.items() if c in word]
+    mask = index.match([i for i, _ in known], [p for _, p in known], mask)
+    free = [word.index(c) for c in set(word) if c not in mapping]
+    return index.exclude(free, list(new_pairs.values()), mask)
+
+
+def anneal(args):
+    """This Function anneals for the key and prints the best one found"""
+    cyphertext = build_cyphertext(args)
+    prettyprint_text('INPUT TEXT', cyphertext)
+
+    model_filename = args['-m'] or frequencies.QUADGRAM_FILE
+    if args['-c']:
+        model = frequencies.ngram_log_probabilities(
+          frequencies.ngram_histogram_file(args['-c'], ANNEAL_NGRAM_SIZE))
+    elif os.path.exists(model_filename):
+        model = frequencies.load_ngram_model(model_filename)
+    else:
+        print("WARNING: No quadgram model \'%s\'"%model_filename,
+          " - building a weaker one from the words list.")
+        model = frequencies.ngram_model_from_words(ANNEAL_NGRAM_SIZE)
+    decodes, score, restarts = anneal_cryptogram(cyphertext, model,
+      float(args['-t']))
+    if not restarts:
+        print("ERROR: No letters to anneal.")
+        return
+    print_substitution(cyphertext, decodes)
+    print("Best of %d restarts scores %.1f"%(restarts, score))
+    prettyprint_guess_file(cyphertext, decodes)
+    return
+
+
+def anneal_cryptogram(cyphertext, model, seconds, processes=None):
+    """Search for the key that makes cyphertext score best against model.
+
+    model is a 26**n array of n-gram log probabilities.  Independent anneal
+    restarts run on a process pool, one worker per core, until seconds have
+    passed.  Only letters are scored, so word spaces are not needed.  A
+    memory mapped model is passed to the workers by filename so they all map
+    the same pages instead of each receiving a copy.
+
+    Returns (decodes, score, restarts) for the best key found, or ({}, 0.0,
+    0) if cyphertext has no letters."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    indexes = frequencies.letter_indexes(cyphertext)
+    if len(indexes) == 0:
+        return {}, 0.0, 0 # nothing to anneal
+    deadline = time.time() + seconds
+    if isinstance(model, numpy.memmap):
+        model = model.filename
+    pool = multiprocessing.Pool(processes, _init_anneal_worker,
+      (indexes, model))
+    try:
+        results = pool.map(_anneal_worker, [(deadline, random.random())
+          for worker in range(processes)])
+    finally:
+        pool.close()
+        pool.join()
+    score, key = max([best for (best, restarts) in results])
+    restarts = sum([restarts for (best, restarts) in results])
+    decodes = dict([(chr(c + 65), chr(key[c] + 65)) for c in set(indexes)])
+    return decodes, score, restarts
+
+
+_anneal_state = {}
+
+
+def _init_anneal_worker(indexes, model):
+    if not isinstance(model, numpy.ndarray):
+        model = frequencies.load_ngram_model(model)
+    _anneal_state['scorer'] = SwapScorer(indexes, model)
+
+
+def _anneal_worker(task):
+    """Run anneal restarts until the deadline; return (best, restarts)."""
+    deadline, seed = task
+    scorer = _anneal_state['scorer']
+    rng = random.Random(seed)
+    best = (-numpy.inf, None)
+    restarts = 0
+    while restarts == 0 or time.time() < deadline:
+        key = list(range(26))
+        rng.shuffle(key)
+        result = anneal_key(scorer, key, rng)
+        restarts += 1
+        if result[0] > best[0]:
+            best = result
+    return best, restarts
+
+
+def anneal_key(scorer, key, rng, steps=ANNEAL_STEPS,
+  temperature=ANNEAL_TEMPERATURE):
+    """Anneal from key by swapping pairs of plainchars.
+
+    Returns (score, key) for the best key seen."""
+    score = scorer.reset(key)
+    best = (score, list(scorer.key))
+    present = scorer.present
+    if not present:
+        return best # no letters, every key scores the same
+    for step in range(steps):
+        t = temperature * (1 - float(step) / steps)
+        a = rng.choice(present) # swapping two absent letters changes nothing
+        b = rng.randrange(25)
+        b += (b >= a)
+        delta = scorer.swap(a, b)
+        if delta >= 0 or (t > 0 and rng.random() < math.exp(delta / t)):
+            score += delta
+            if score > best[0]:
+                best = (score, list(scorer.key))
+        else:
+            scorer.swap(a, b) # undo
+    return best
+
+
+class SwapScorer(object):
+    """Incrementally score a cyphertext under a key as plainchars swap.
+
+    key[c] is the plainchar for cypherchar c (both 0..25).  Swapping the
+    plainchars of two cypherchars only changes the n-grams that contain one
+    of them, so swap() rescores just those windows instead of the whole
+    text."""
+
+    def __init__(self, indexes, model):
+        self.indexes = indexes
+        self.model = model
+        self.n = int(round(math.log(len(model), 26)))
+        self.windows = max(len(indexes) - self.n + 1, 0)
+        self.positions = [numpy.flatnonzero(indexes == c) for c in range(26)]
+        self.present = [c for c in range(26) if len(self.positions[c])]
+        # windows_with[c] lists the windows (by first position) containing c
+        self.windows_with = []
+        for positions in self.positions:
+            starts = (positions[:, None] - numpy.arange(self.n)).ravel()
+            starts = starts[(starts >= 0) & (starts < self.windows)]
+            self.windows_with.append(numpy.unique(starts))
+        self._pair_windows = {}
+
+    def reset(self, key):
+        """Use key from now on and return its full score."""
+        self.key = numpy.array(key)
+        self.plain = self.key[self.indexes]
+        return frequencies.ngram_score(self.plain, self.model)
+
+    def swap(self, a, b):
+        """Swap the plainchars of cypherchars a and b; return the change in
+        score."""
+        windows = self._windows_for(a, b)
+        before = self._score_windows(windows)
+        self.key[a], self.key[b] = self.key[b], self.key[a]
+        self.plain[self.positions[a]] = self.key[a]
+        self.plain[self.positions[b]] = self.key[b]
+        return self._score_windows(windows) - before
+
+    def _windows_for(self, a, b):
+        pair = (min(a, b), max(a, b))
+        if pair not in self._pair_windows:
+            self._pair_windows[pair] = numpy.union1d(self.windows_with[a],
+              self.windows_with[b])
+        return self._pair_windows[pair]
+
+    def _score_windows(self, windows):
+        packed = numpy.zeros(len(windows), numpy.intp)
+        for k in range(self.n):
+            packed = packed * 26 + self.plain[windows + k]
+        return float(self.model[packed].sum())
+
+
 def analyze(args):
+    if args['--batch']:
+        analyze_batch(args['--batch'], args['-i'], args['-p'])
+        return
     # BUILD & PRINT CYPHERTEXT
     cyphertext = build_cyphertext(args)
     prettyprint_text('INPUT TEXT', cyphertext)
+    stats = TextStats(cyphertext)
 
     # CHARACTER COUNTS
-    cypher_char_counts = count_chars(cyphertext)
-    prettyprint_counts('CHARACTER', cypher_char_counts)
+    prettyprint_counts('CHARACTER', stats.char_counts)
+
+    # INDEX OF COINCIDENCE
+    prettyprint_index_of_coincidence(stats.index_of_coincidence)
 
     # DOUBLES
-    highlight_doubles(cyphertext)
+    highlight_doubles(stats)
 
     # CHARACTER SEQUENCES
-    sequence_counts = count_sequences(cyphertext)
-    prettyprint_counts('SEQUENCE', sequence_counts)
+    prettyprint_counts('SEQUENCE', stats.sequences)
 
     # IDENTIFY POTENTIAL VOWELLS
-    sukhotin(cyphertext)
+    sukhotin(stats)
 
     return
 
+def analyze_batch(filename, ignore_spaces=False, processes=None):
+    """Analyze every line of filename on a process pool, printing JSONL."""
+    if processes is not None:
+        processes = int(processes)
+    fdin = sys.stdin if filename == '-' else open(filename, 'r')
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(functools.partial(analyze_record,
+          ignore_spaces=ignore_spaces), enumerate(fdin, 1), BATCH_CHUNKSIZE)
+        for result in results:
+            sys.stdout.write(result + '\n')
+    finally:
+        pool.close()
+        pool.join()
+        if fdin is not sys.stdin:
+            fdin.close()
+    return
+
+
+def analyze_record(numbered_line, ignore_spaces=False):
+    """Analyze one (line number, line) of --batch input; return the result
+    as a JSON string.
+
+    Blank lines and lines that fail to analyze give an "error" result, so
+    every input line has exactly one output line."""
+    number, line = numbered_line
+    result = {'line' : number}
+    line = line.strip()
+    try:
+        if not line:
+            raise ValueError('blank line')
+        if line.startswith('{'):
+            record = json.loads(line)
+            if 'id' in record:
+                result['id'] = record['id']
+            text = record['cyphertext']
+        else:
+            text = line
+        cyphertext = build_cyphertext({'<cyphertext>' : text.split(),
+          '-i' : ignore_spaces})
+        result.update(analyze_text(cyphertext))
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return json.dumps(result, sort_keys=True)
+
+
+def analyze_text(cyphertext):
+    """Return the analyze statistics for cyphertext as a dictionary."""
+    stats = TextStats(cyphertext)
+    return {
+      'cyphertext' : cyphertext,
+      'char_counts' : stats.char_counts,
+      'doubles' : stats.doubles,
+      'index_of_coincidence' : stats.index_of_coincidence,
+      'sequences' : stats.sequences,
+      'vowels' : stats.vowels,
+      }
+
+
+def _cached_property(method):
+    """Make method a read-only property computed once per TextStats."""
+    name = method.__name__
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = method(self)
+            return value
+    getter.__doc__ = method.__doc__
+    return property(getter)
+
+
+class TextStats(object):
+    """Every statistic analyze reports for one cyphertext.
+
+    The text is converted to bytes once and each statistic is derived from
+    those bytes (the n-gram counts from one more pass over the text) the first
+    time it is read, then cached."""
+
+    def __init__(self, text, sizes=SEQUENCE_SIZES):
+        self.text = text
+        self.sizes = sizes
+        self._cache = {}
+
+    @_cached_property
+    def raw(self):
+        """The text as ascii bytes."""
+        if isinstance(self.text, bytes):
+            return self.text
+        return self.text.encode('ascii', 'replace')
+
+    @_cached_property
+    def codes(self):
+        """The text as a numpy uint8 array of character codes."""
+        return numpy.frombuffer(self.raw, numpy.uint8)
+
+    @_cached_property
+    def indexes(self):
+        """frequencies.text_indexes() of the text."""
+        return frequencies.text_indexes(self.raw)
+
+    @_cached_property
+    def char_counts(self):
+        """Dictionary of letter (either case) to number of occurrences."""
+        counts = numpy.bincount(self.codes, minlength=256)
+        return dict([(c, int(counts[ord(c)])) for c in string.ascii_letters
+          if counts[ord(c)]])
+
+    @_cached_property
+    def letter_histogram(self):
+        """numpy array of the count of each letter A..Z."""
+        return numpy.bincount(self.indexes, minlength=27)[:26]
+
+    @_cached_property
+    def index_of_coincidence(self):
+        """frequencies.index_of_coincidence() of the letters."""
+        return float(frequencies.index_of_coincidence(self.letter_histogram))
+
+    @_cached_property
+    def doubles(self):
+        """Position of the first character of each pair of equal characters."""
+        codes = self.codes
+        return numpy.flatnonzero(codes[1:] == codes[:-1]).tolist()
+
+    @_cached_property
+    def ngram_counts(self):
+        """frequencies.NGramCounter of the sequence sizes."""
+        return frequencies.count_ngrams(self.text, self.sizes)
+
+    @_cached_property
+    def sequences(self):
+        """Dictionary of every sequence that occurs more than once."""
+        counter = self.ngram_counts
+        counts = {}
+        for n in counter.sizes:
+            for sequence, count in counter.counts[n].items():
+                if count > 1: # skip sequences that only occured once
+                    counts[sequence] = count
+        return counts
+
+    @_cached_property
+    def adjacency(self):
+        """frequencies.adjacency_matrix() of the text."""
+        return frequencies.adjacency_matrix(self.indexes)
+
+    @_cached_property
+    def vowels(self):
+        """Likely vowels in order of confidence, by Sukhotin's algorithm."""
+        return sukhotin_vowels(self.adjacency)
+
+
 def sukhotin(text):
-    freq = [ [ 0 for ii in range(26) ] for jj in range(26) ]
-    for letter in string.uppercase:
-        c = "@"
-        last_c = "@"
-        for next_c in text+"@":
-            if c == letter:
-                #print("DEBUG: ", "last_c=%s, "%last_c, "c=%s, "%c, "next_c=%s."%next_c)
-                if last_c in string.uppercase:
-                    freq[(ord(c)-65)][(ord(last_c)-65)] += 1
-                    freq[(ord(last_c)-65)][(ord(c)-65)] += 1
-                if next_c in string.uppercase:
-                    freq[(ord(c)-65)][(ord(next_c)-65)] += 1
-                    freq[(ord(next_c)-65)][(ord(c)-65)] += 1
-            last_c = c
-            c = next_c
-    # zero diagonal
-    for ii in range(26):
-        freq[ii][ii] = 0
-
-    # Determine SUMS:
-    sums = [0 for ii in range(26)]
-    letter_types = ["C" for ii in range(26)]
-    for ii in range(26):
-        sums[ii] = sum(freq[ii])
-
-    # Identify Vowells 
-    vowels = []
-    for round_num in range(1,6):
-        if round_num > 1:
-            # reduce sums for letters connected to last round's winner
-            for ii in range(26):
-                sums[ii] -= freq[ii][ord(max_letter)-65]*2
-        # get max sum
-        max_sum = 0
-        for ii in range(26):
-            if letter_types[ii] == "C" and sums[ii] > max_sum:
-                max_sum = sums[ii]
-        # get letter
-        max_letters = [chr(ii+65) for ii,value in enumerate(sums) if (
-          value == max_sum and letter_types[ii] == "C")]
-        max_letter = max_letters[0] # pick lowest letter if there is a tie
-        letter_types[ord(max_letter)-65] = "V"
-        # debugging
-        #print_sukhotin_state_debug(freq, sums, letter_types)
-        vowels.append(max_letter)
+    ''' Print the likely vowels of text (a string or a TextStats) '''
+    stats = text if isinstance(text, TextStats) else TextStats(text)
+    vowels = stats.vowels
     print ("\n== SUKHOTIN ==")
     print("Vowell(s) in order of confidence are ", vowels)
-    return 
+    return vowels
+
+
+def sukhotin_vowels(matrix, rounds=5):
+    """Identify likely vowels with Sukhotin's algorithm.
+
+    matrix is an adjacency_matrix(); letters that sit next to many different
+    letters are vowels.  Each round picks the consonant with the highest
+    remaining adjacency sum (lowest letter on a tie) as a vowel, then removes
+    its contribution from the sums of its neighbours."""
+    freq = matrix + matrix.T
+    numpy.fill_diagonal(freq, 0)
+    sums = freq.sum(axis=1)
+    is_vowel = numpy.zeros(26, dtype=bool)
+    vowels = []
+    for round_num in range(rounds):
+        consonant_sums = numpy.where(is_vowel, sums.min() - 1, sums)
+        max_letter = int(numpy.argmax(consonant_sums))
+        is_vowel[max_letter] = True
+        sums -= freq[:, max_letter] * 2
+        # debugging
+        #print_sukhotin_state_debug(freq, sums,
+        #  ["V" if v else "C" for v in is_vowel])
+        vowels.append(chr(max_letter + 65))
+    return vowels
+
 
 def print_sukhotin_state_debug(freq, sums, letter_types):
     print ("== SUKHOTIN ==")
@@ -188,65 +809,26 @@ def print_sukhotin_state_debug(freq, sums, letter_types):
     return
 
 
-def count_sequences(text):
+def count_sequences(text, sizes=SEQUENCE_SIZES):
     ''' Count recurring sequences of characters '''
-    counts = {}
-    last_c = ""
-    second_last_c = ""
-    for c in text:
-        sequence2chars = last_c + c
-        sequence3chars = second_last_c + last_c + c
-        # check if sequence2chars contains punctuation or space
-        sequence2chars_valid = True
-        for char in sequence2chars:
-            if char not in string.letters and char not in string.digits:
-                sequence2chars_valid = False
-                break
-        # check if sequence3chars contains punctuation or space
-        sequence3chars_valid = True
-        for char in sequence3chars:
-            if char not in string.letters and char not in string.digits:
-                sequence3chars_valid = False
-                break
-        if sequence2chars_valid:
-            if sequence2chars not in counts.keys():
-                counts[sequence2chars] = 1
-            else:
-                counts[sequence2chars] += 1
-        if sequence3chars_valid:
-            if sequence3chars not in counts.keys():
-                counts[sequence3chars] = 1
-            else:
-                counts[sequence3chars] += 1
-        second_last_c = last_c
-        last_c = c
-    # remove all counts that only occured once
-    for key, value in counts.items():
-        if value == 1:
-            del counts[key]
-    return counts
+    return TextStats(text, sizes).sequences
 
 
 def highlight_doubles(text):
-    ''' Show where doubles occur in text '''
+    ''' Show where doubles occur in text (a string or a TextStats) '''
+    stats = text if isinstance(text, TextStats) else TextStats(text)
     print("== DOUBLES ==")
-    last_c = ""
-    doubles = ""
-    for ii,c in enumerate(text):
-        if ii !=0 and ii%80 == 0:
-            print('\n', doubles)
-            doubles = ""
-        if c == last_c:
-            doubles = doubles[:-2] + '^^ '
-        else:
-            doubles += ' '
-        print(c, sep='', end='')
-        last_c = c   
-    if len(doubles)>0:
-        print('\n', doubles)
+    text = stats.text
+    marks = [' '] * (len(text) + 1)
+    for ii in stats.doubles:
+        marks[ii:ii + 2] = ['^', '^']
+    marks = ''.join(marks)
+    for start in range(0, len(text), LINE_WIDTH):
+        print(text[start:start + LINE_WIDTH])
+        print(marks[start:start + LINE_WIDTH])
     print("The most common English doubles are {ll, tt, ss, ee, pp, oo, rr, ff, cc, dd, nn}", '\n')
     return
-    
+
 
 def prettyprint_counts(title, counts):
     ''' print counts with formatting '''
@@ -263,6 +845,15 @@ def prettyprint_counts(title, counts):
     return
 
 
+def prettyprint_index_of_coincidence(index):
+    ''' print the index of coincidence next to English and random text '''
+    print("== INDEX OF COINCIDENCE ==")
+    print("%.4f (English text %.4f, random letters %.4f)"%(index,
+      frequencies.ENGLISH_IC, frequencies.RANDOM_IC))
+    print("A simple substitution cypher keeps the index of English text", '\n')
+    return
+
+
 def prettyprint_text(title, text):
     print("\n== %s =="%title)
     for ii,c in enumerate(text):
@@ -274,16 +865,8 @@ def prettyprint_text(title, text):
 
 
 def count_chars(cyphertext):
-    counts = {}
-    for c in cyphertext:
-        if not c in string.ascii_letters:
-            # excludes numbers, symbols, spaces, and punctuation
-            continue
-        if c not in counts.keys():
-            counts[c] = 1
-        else:
-            counts[c] += 1
-    return counts
+    # excludes numbers, symbols, spaces, and punctuation
+    return TextStats(cyphertext).char_counts
 
 
 def build_cyphertext(args):
@@ -314,9 +897,234 @@ def build_cyphertext(args):
     return cyphertext
 
 
+# =============================================================================
+# TESTS
+# =============================================================================
+def test_solve_cryptogram():
+    '''Test function solve_cryptogram().'''
+    # "the cat ate" shifted by 3; "zox jqz qzx" also fits and is tried first,
+    # but its letters score worse
+    patterns = {"ABC" : ["zox", "jqz", "qzx", "the", "cat", "ate"]}
+    decodes, unsolved_words = solve_cryptogram("WKH FDW DWH QQQ", patterns)
+    if render_substitution("WKH FDW DWH", decodes, 'plain') != "THE CAT ATE":
+        return False # failed
+    if unsolved_words != ["QQQ"]:
+        return False # failed
+    # without the budget for a complete mapping the best partial one is kept
+    decodes, unsolved_words = solve_cryptogram("WKH FDW", patterns,
+      max_nodes=1)
+    if decodes or unsolved_words != ["FDW", "WKH"]:
+        return False # failed
+    return True # passed
+
+
+def test_candidate_filter():
+    '''Test function _candidate_filter().'''
+    index = frequencies.PositionIndex(["the", "tie", "toe", "she", "ohm"])
+    # T = t was just mapped; E = e was mapped before
+    mask = _candidate_filter("TIE", index, index.all, {"T" : "t", "E" : "e"},
+      {"T" : "t"})
+    if index.select(mask) != ["the", "tie", "toe"]:
+        return False # failed
+    # H = o was just mapped, so no other free cypherchar may decode to o
+    mask = _candidate_filter("TIE", index, mask, {"T" : "t", "E" : "e",
+      "H" : "o"}, {"H" : "o"})
+    if index.select(mask) != ["the", "tie"]:
+        return False # failed
+    return True # passed
+
+
+def test_sukhotin_vowels():
+    '''Test function sukhotin_vowels() against the original loop version.'''
+    expected = [
+      ("NOW IS THE TIME FOR ALL GOOD MEN TO COME TO THE AID OF THE PARTY",
+        ['O', 'E', 'I', 'A', 'T']),
+      ("PGN JIRXC AUHFD BHK MIQOW HLNU PGN TYVS EHZ",
+        ['H', 'G', 'I', 'O', 'V']),
+      ("XYZZY", ['Y', 'A', 'B', 'C', 'D']),
+      ("AAB", ['A', 'C', 'D', 'E', 'F']),
+      ]
+    for text, vowels in expected:
+        if sukhotin_vowels(frequencies.adjacency_matrix(text)) != vowels:
+            return False # failed
+    return True # passed
+
+
+def test_swap_scorer():
+    '''Test that SwapScorer.swap() deltas match a full rescore.'''
+    model = frequencies.ngram_model_from_words(3)
+    indexes = frequencies.letter_indexes("NOWISTHETIMEFORALLGOODMENTOCOME")
+    scorer = SwapScorer(indexes, model)
+    rng = random.Random(1)
+    key = list(range(26))
+    rng.shuffle(key)
+    score = scorer.reset(key)
+    for step in range(50):
+        a, b = rng.sample(range(26), 2)
+        score += scorer.swap(a, b)
+        key[a], key[b] = key[b], key[a]
+        full = frequencies.ngram_score(numpy.array(key)[indexes], model)
+        if abs(score - full) > 1e-3 or list(scorer.key) != key: # float32 model
+            return False # failed
+    return True # passed
+
+
+def test_anneal():
+    '''Test functions anneal_key() and anneal_cryptogram().'''
+    plaintext = "NOW IS THE TIME FOR ALL GOOD MEN TO COME TO THE AID OF " \
+      "THE PARTY"
+    cyphertext = "QRZ LV WKH WLPH IRU DOO JRRG PHQ WR FRPH WR WKH DLG RI " \
+      "WKH SDUWB"
+    # a model of the plaintext itself makes the right key the best one
+    model = frequencies.ngram_log_probabilities(frequencies.ngram_histogram(
+      plaintext, 3))
+    indexes = frequencies.letter_indexes(cyphertext)
+    scorer = SwapScorer(indexes, model)
+    best = (-numpy.inf, None)
+    for seed in range(5):
+        rng = random.Random(seed)
+        key = list(range(26))
+        rng.shuffle(key)
+        best = max(best, anneal_key(scorer, key, rng))
+    decodes = dict([(chr(c + 65), chr(best[1][c] + 65)) for c in set(indexes)])
+    if render_substitution(cyphertext, decodes, 'plain') != plaintext:
+        return False # failed
+    decodes, score, restarts = anneal_cryptogram(cyphertext, model, 0, 1)
+    if restarts != 1 or sorted(decodes) != sorted(set(cyphertext) - set(' ')):
+        return False # failed
+    if len(set(decodes.values())) != len(decodes):
+        return False # failed, two cypherchars share a plainchar
+    if abs(score - frequencies.ngram_score(render_substitution(cyphertext,
+      decodes, 'plain'), model)) > 1e-3:
+        return False # failed
+    if anneal_cryptogram("123 456", model, 0, 1) != ({}, 0.0, 0):
+        return False # failed
+    return True # passed
+
+
+def test_render_substitution():
+    '''Test function render_substitution().'''
+    decodes = {"W" : "T", "K" : "H", "H" : "E"}
+    if render_substitution("WKH FDW!", decodes, 'plain') != "THE fdT!":
+        return False # failed
+    record = json.loads(render_substitution("WKH FDW!", decodes, 'json'))
+    if record != {"cyphertext" : "WKH FDW!", "plaintext" : "THE fdT!",
+      "decodes" : decodes}:
+        return False # failed
+    expected = colored("THE", 'blue', attrs=['bold']) + \
+      colored(" fd", 'green', 'on_grey', attrs=['underline']) + \
+      colored("T", 'blue', attrs=['bold']) + \
+      colored("!", 'green', 'on_grey', attrs=['underline'])
+    if render_substitution("WKH FDW!", decodes, 'color') != expected:
+        return False # failed
+    return True # passed
+
+
+def test_text_stats():
+    '''Test the TextStats statistics and their caching.'''
+    stats = TextStats("HELLO, WORLD. LOOK AT THE HELL", (2, 3))
+    if stats.char_counts != {'A' : 1, 'D' : 1, 'E' : 3, 'H' : 3, 'K' : 1,
+      'L' : 6, 'O' : 4, 'R' : 1, 'T' : 2, 'W' : 1}:
+        return False # failed
+    if stats.sequences != {'EL' : 2, 'ELL' : 2, 'HE' : 3, 'HEL' : 2,
+      'LL' : 2, 'LO' : 2}:
+        return False # failed
+    if stats.doubles != [2, 15, 28]:
+        return False # failed
+    # (6*5 + 4*3 + 3*2 + 3*2 + 2*1) / (23*22)
+    if abs(stats.index_of_coincidence - 56.0 / 506) > 1e-12:
+        return False # failed
+    if stats.vowels != sukhotin_vowels(frequencies.adjacency_matrix(
+      stats.text)):
+        return False # failed
+    if stats.adjacency is not stats.adjacency:
+        return False # failed, not cached
+    return True # passed
+
+
+def test_analyze_record():
+    '''Test function analyze_record().'''
+    result = json.loads(analyze_record((1, "abc abc\n")))
+    if result != {"char_counts" : {"A" : 2, "B" : 2, "C" : 2},
+      "cyphertext" : "ABC ABC", "doubles" : [], "index_of_coincidence" : 0.2,
+      "line" : 1, "sequences" : {"AB" : 2, "ABC" : 2, "BC" : 2},
+      "vowels" : ["B", "D", "E", "F", "G"]}:
+        return False # failed
+    result = json.loads(analyze_record((2,
+      '{"id": "x7", "cyphertext": "AA"}\n')))
+    if result["id"] != "x7" or result["line"] != 2 or \
+      result["cyphertext"] != "AA" or result["doubles"] != [0]:
+        return False # failed
+    if json.loads(analyze_record((3, "  \n"))) != {"line" : 3,
+      "error" : "ValueError: blank line"}:
+        return False # failed
+    if json.loads(analyze_record((4, '{"id": 9}\n'))) != {"line" : 4,
+      "id" : 9, "error" : "KeyError: 'cyphertext'"}:
+        return False # failed
+    result = json.loads(analyze_record((5, "{bad\n")))
+    if sorted(result) != ["error", "line"] or result["line"] != 5 or \
+      not result["error"].startswith("ValueError: "):
+        return False # failed, the message depends on the json version
+    return True # passed
+
+
+def test_substitution_view():
+    '''Test that SubstitutionView re-renders only the changed lines.'''
+    view = SubstitutionView("ABCDEFGHIJ KL", 'plain', width=5)
+    if view.lines != ["ABCDE", "FGHIJ", " KL"]:
+        return False # failed
+    if view.update({"A" : "T"}) != [0]:
+        return False # failed
+    # K is new and A is unchanged, so only the last line is redrawn
+    if view.update({"A" : "T", "K" : "O"}) != [2]:
+        return False # failed
+    if view.update({"A" : "T", "K" : "O"}) != []:
+        return False # failed
+    if view.render() != "ABCDE\nTbcde\n\nFGHIJ\nfghij\n\n KL\n Ol\n\n":
+        return False # failed
+    # dropping a decode redraws its lines too
+    if view.update({"K" : "O"}) != [0] or view.rendered[0] != "abcde":
+        return False # failed
+    return True # passed
+
+
+def run_tests():
+    '''Run all tests for this file.'''
+    result = "passed" # start assuming tests will pass
+    print("\n"+15*'=', "Testing module %s" % __file__, 15*'=')
+    tests = [
+      (test_solve_cryptogram(), "Test solve_cryptogram:"),
+      (test_candidate_filter(), "Test _candidate_filter:"),
+      (test_sukhotin_vowels(), "Test sukhotin_vowels:"),
+      (test_swap_scorer(), "Test SwapScorer:"),
+      (test_anneal(), "Test anneal_key and anneal_cryptogram:"),
+      (test_render_substitution(), "Test render_substitution:"),
+      (test_text_stats(), "Test TextStats:"),
+      (test_analyze_record(), "Test analyze_record:"),
+      (test_substitution_view(), "Test SubstitutionView:"),
+      ]
+    for test in tests:
+        this_result = "passed" if test[0] else "failed"
+        print("%-46s"%test[1], this_result)
+        if not test[0]:
+            result = "failed"
+
+    if result != "passed":
+        print(15*'=',"Result: One or more tests failed.", 15*'=')
+        return False # failed one or more tests
+    print(15*'=', "Result: All tests passed.", 15*'=')
+    return True # passed all tests
+
+
 if __name__ == '__main__':
     args = docopt(__doc__, version='%s %s:%s'%(NAME, VERSION, DATE))
     if args['sub']:
         substitute(args)
+    elif args['solve']:
+        solve(args)
+    elif args['anneal']:
+        anneal(args)
+    elif args['test']:
+        result = run_tests()
     else:
         analyze(args)
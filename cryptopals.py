@@ -1,6 +1,14 @@
 import base64
-import re
+import collections
+import heapq
+import itertools
+import multiprocessing
+import string
+import sys
+import time
+import numpy
 from Crypto.Cipher import AES
+import frequencies
 
 INPUT_STRING_1_1 = "49276d206b696c6c696e6720796f757220627261696e206c696b65206120706f69736f6e6f7573206d757368726f6f6d"
 EXPECTED_B64_1_1 = "SSdtIGtpbGxpbmcgeW91ciBicmFpbiBsaWtlIGEgcG9pc29ub3VzIG11c2hyb29t"
@@ -10,9 +18,60 @@ INPUT_STRING_B_1_2 = "686974207468652062756c6c277320657965"
 EXPECTED_STRING_1_2 = "746865206b696420646f6e277420706c6179"
 
 INPUT_STRING_1_3 = "1b37373331363f78151b7f2b783431333d78397828372d363c78373e783a393b3736"
-ENGLISH_CHARS = re.compile("[a-z, A-Z, ' ', ',', ';', ':', '?', '!', '\'', '\"']")
+ENGLISH_BYTES = (string.ascii_letters + string.digits + " \n.,;:?!'\"-()").encode('ascii')
+SPACE_FREQ = 0.18         # share of english text that is spaces
+PUNCTUATION_FREQ = 1e-3   # probability of each other printable character
+UNPRINTABLE_FREQ = 1e-6   # probability of each unprintable byte
+QUADGRAM_SHORTLIST = 8    # keys rescored when solving with a quadgram model
+
+
+def printable_profile():
+    """
+    Byte weights scoring the share of characters that are in ENGLISH_BYTES.
+
+    """
+    weights = numpy.zeros(256)
+    weights[numpy.frombuffer(ENGLISH_BYTES, numpy.uint8)] = 1.0
+    return weights
+
+
+def letter_profile():
+    """
+    Byte weights scoring the mean log10 probability of each character.
+
+    Letters (either case) share the text with spaces and are weighted by
+    frequencies.log_likelihood, so on letters alone the profile ranks text
+    the same way; other printable characters are rare and unprintable bytes
+    rarer still.
+
+    """
+    weights = numpy.full(256, numpy.log10(UNPRINTABLE_FREQ))
+    weights[numpy.frombuffer(string.printable.encode('ascii'), numpy.uint8)] = \
+        numpy.log10(PUNCTUATION_FREQ)
+    weights[ord(' ')] = numpy.log10(SPACE_FREQ)
+    letters = frequencies.log_likelihood(numpy.eye(26)) + \
+        numpy.log10(1 - SPACE_FREQ)
+    weights[ord('A'):ord('Z') + 1] = letters
+    weights[ord('a'):ord('z') + 1] = letters
+    return weights
+
+
+PRINTABLE_PROFILE = printable_profile()
+LETTER_PROFILE = letter_profile()
+# XOR_PERMUTATIONS[k][b] is b ^ k: xor with key k moves byte b's count there
+XOR_PERMUTATIONS = numpy.bitwise_xor.outer(numpy.arange(256), numpy.arange(256))
+# ENGLISH_KEY_WEIGHTS[k][b] is the weight byte b gets once xord with key k
+ENGLISH_KEY_WEIGHTS = PRINTABLE_PROFILE[XOR_PERMUTATIONS]
+LETTER_KEY_WEIGHTS = LETTER_PROFILE[XOR_PERMUTATIONS]
+XOR_TABLES = [bytes(row.astype(numpy.uint8)) for row in XOR_PERMUTATIONS]
 
 FILENAME4 = "4.txt"
+SCAN_TOP_K = 10            # candidates kept by scan_single_byte_xor
+SCAN_CHUNK_SIZE = 512      # records solved per worker task
+SCAN_TASKS_PER_PROCESS = 4 # tasks in flight per worker, bounds memory
+PROGRESS_INTERVAL = 1.0    # seconds between progress reports
+# POPCOUNT_TABLE[b] is the number of ones in byte b
+POPCOUNT_TABLE = numpy.array([bin(b).count('1') for b in range(256)], numpy.uint8)
 
 INPUT_STRING_1_5 = "Burning 'em, if you ain't quick and nimble\nI go crazy when I hear a cymbal"
 INPUT_KEY_1_5 = "ICE"
@@ -133,18 +192,11 @@ def detect_single_byte_xor_decypher(filename, verbose=False):
     file of hexadecimal string lines and determines the plain_text. 
 
     """
-    solutions = []
-    count = 0
-    # read file
-    with open(filename) as fd:
-        for line in fd:
-            cypher_text = line.strip()
-            count += 1
-            plain_text, _, key, score = solve_single_byte_xor_cypher(cypher_text, must_solve=False)
-            if score > 0.95:
-                solutions.append((plain_text, cypher_text, key, score))
-    if verbose:
-        print('read %d lines' % count)
+    progress = sys.stdout if verbose else None
+    candidates = scan_single_byte_xor(filename, progress=progress)
+    solutions = [(plain_text, cypher_text, key, score)
+                 for score, _, key, plain_text, cypher_text in candidates
+                 if score > 0.95]
 
     # print results
     if verbose:
@@ -156,6 +208,175 @@ def detect_single_byte_xor_decypher(filename, verbose=False):
     return solutions
 
 
+def scan_single_byte_xor(filename, encoding='hex', top=SCAN_TOP_K,
+                         processes=None, profile=PRINTABLE_PROFILE,
+                         progress=None, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Find the records of filename most likely to be single byte xor cyphers.
+
+    filename ('-' for stdin) holds one record per line, encoded as 'hex',
+    'base64' or 'raw' bytes.  Lines are handed to a pool of processes in
+    chunks, with only a few chunks in flight per process, and only the best
+    top candidates are kept, so memory does not grow with the file.  Records
+    that do not decode are skipped.  If progress is a file, the records and
+    bytes scanned and the throughput are written to it as the scan runs.
+    profile is handed to each process once when the pool starts; a memory
+    mapped n-gram model goes by filename so every process maps the same
+    pages.
+
+    Returns [(score, line_number, key, plain_text, cypher_text), ...] best
+    first.
+
+    """
+    fd = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    processes = processes or multiprocessing.cpu_count()
+    records = enumerate(fd, 1)
+    chunks = iter(lambda: list(itertools.islice(records, chunk_size)), [])
+    best = []
+    stats = {'records': 0, 'bytes': 0, 'start': time.time(), 'reported': 0.0}
+    pool = None
+    if processes > 1:
+        if isinstance(profile, numpy.memmap):
+            profile = profile.filename
+        pool = multiprocessing.Pool(processes, _init_scan_worker, (profile,))
+    try:
+        if pool is None:
+            for chunk in chunks:
+                _merge_scan(best, _scan_records(chunk, encoding, top, profile),
+                            top, stats, progress)
+        else:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_scan_records,
+                                                (chunk, encoding, top)))
+                if len(pending) >= processes * SCAN_TASKS_PER_PROCESS:
+                    _merge_scan(best, pending.popleft().get(), top, stats,
+                                progress)
+            while pending:
+                _merge_scan(best, pending.popleft().get(), top, stats, progress)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if fd is not sys.stdin.buffer:
+            fd.close()
+    if progress is not None:
+        _report_scan(stats, progress)
+    return [(score, -negative_line_number, key, plain_text, cypher_text)
+            for score, negative_line_number, key, plain_text, cypher_text
+            in sorted(best, reverse=True)]
+
+
+def decode_record(line, encoding='hex'):
+    """
+    Convert one line of a scanned file to bytes.
+
+    """
+    if encoding == 'hex':
+        return bytes.fromhex(line.strip().decode('ascii'))
+    if encoding == 'base64':
+        return base64.b64decode(line.strip(), validate=True)
+    if encoding == 'raw':
+        return line.rstrip(b'\r\n')
+    raise ValueError('unknown record encoding %r' % encoding)
+
+
+_scan_state = {}
+
+
+def _init_scan_worker(profile):
+    if not isinstance(profile, numpy.ndarray):
+        profile = frequencies.load_ngram_model(profile)
+    _scan_state['profile'] = profile
+
+
+def _scan_records(records, encoding, top, profile=None):
+    """
+    Solve a chunk of (line_number, line) records in a worker process.
+
+    profile defaults to the one the pool handed the worker at startup.
+
+    With a byte weight profile the histograms of the whole chunk are scored
+    against every key in one matrix product, and only records that make the
+    top candidates are decrypted.
+
+    Returns (best top candidates as a heap, records read, bytes read); line
+    numbers are negated so an earlier line wins a tie.
+
+    """
+    if profile is None:
+        profile = _scan_state['profile']
+    size = 0
+    decoded = []
+    for line_number, line in records:
+        size += len(line)
+        try:
+            b_cypher = decode_record(line, encoding)
+        except ValueError:
+            continue  # not a record of this encoding
+        if b_cypher:
+            decoded.append((line_number, line, b_cypher))
+    if decoded and len(profile) == 256:
+        lengths = numpy.array([len(b_cypher) for _, _, b_cypher in decoded])
+        codes = numpy.frombuffer(b''.join([b_cypher for _, _, b_cypher in decoded]),
+                                 numpy.uint8)
+        rows = numpy.repeat(numpy.arange(len(decoded)) * 256, lengths)
+        histograms = numpy.bincount(rows + codes, minlength=len(decoded) * 256)
+        scores = histograms.reshape(-1, 256).dot(key_weights(profile).T)
+        keys = numpy.argmax(scores, axis=1)  # lowest key wins a tie
+        solved = zip(scores[numpy.arange(len(decoded)), keys] / lengths, keys)
+    else:
+        solved = []
+        for _, _, b_cypher in decoded:
+            _, key, score = solve_single_byte_xor_cypher_on_bytes(b_cypher,
+                                                                  profile=profile)
+            solved.append((score, key))
+    best = []
+    for (line_number, line, b_cypher), (score, key) in zip(decoded, solved):
+        if len(best) == top and (score, -line_number) <= best[0][:2]:
+            continue
+        candidate = (float(score), -line_number, int(key),
+                     ascii_string_from_bytes(b_cypher.translate(XOR_TABLES[key])),
+                     line.strip().decode('latin-1'))
+        if len(best) < top:
+            heapq.heappush(best, candidate)
+        else:
+            heapq.heapreplace(best, candidate)
+    return best, len(records), size
+
+
+def _merge_scan(best, result, top, stats, progress):
+    """
+    Fold one _scan_records() result into the overall top candidates.
+
+    """
+    candidates, count, size = result
+    for candidate in candidates:
+        if len(best) < top:
+            heapq.heappush(best, candidate)
+        elif candidate > best[0]:
+            heapq.heapreplace(best, candidate)
+    stats['records'] += count
+    stats['bytes'] += size
+    if progress is not None and \
+            time.time() - stats['reported'] >= PROGRESS_INTERVAL:
+        _report_scan(stats, progress)
+
+
+def _report_scan(stats, progress):
+    """
+    Write the records and bytes scanned so far and the throughput.
+
+    """
+    stats['reported'] = time.time()
+    elapsed = max(stats['reported'] - stats['start'], 1e-9)
+    print('scanned %d records (%.1f MB) in %.1fs: %.0f records/s, %.2f MB/s'
+          % (stats['records'], stats['bytes'] / 1e6, elapsed,
+             stats['records'] / elapsed, stats['bytes'] / 1e6 / elapsed),
+          file=progress)
+    progress.flush()
+
+
 def multi_byte_xor_encypher(plain_text, key_text, verbose=False):
     """
     Solve Cryptopals Set 1 challenge 5: Implement repeating-key XOR
@@ -385,30 +606,31 @@ def determine_key_length(b_cypher, verbose=False):
     """
     Determine the key length of a repeating key xor cypher bytes.
 
-    For various keysizes compute the hamming distance between the first KEYSIZE
-    bytes and the second KEYSIZE bytes of cypher_text.  Get the normalized 
-    hamming distance by dividing the hamming distance by the key length.  The
-    KEYSIZE with the lowest corresponding normalized hamming distance is
-    probably the correct key_length.
+    For various keysizes split cypher_text into blocks of 2 * KEYSIZE bytes
+    and compute the hamming distance between the first block and every other
+    block at once.  Get the normalized hamming distance by dividing the mean
+    hamming distance by the block length.  The KEYSIZE with the lowest
+    corresponding normalized hamming distance is probably the correct
+    key_length.
 
-    Returns our guess at key length (an integer).
+    Returns the key lengths to try, most likely first.
 
     """
-    #b = bytes_from_ascii_string(cypher_text)
     possible_key_lengths = range(2, 40)
     normalized_hamming_distances = []
     for key_length in possible_key_lengths:
-        sample1 = b_cypher[0:key_length * 2]
-        sample2 = b_cypher[key_length * 2:key_length * 4]
-        if verbose:
-            print("Checking key length %d." % key_length)
-            print(len(sample1), sample1)
-            print(len(sample2), sample2)
-        hd = compute_hamming_distance(sample1, sample2, verbose=verbose)
-        normalized_hd = float(hd) / float(len(sample1))
+        block_length = key_length * 2
+        blocks = len(b_cypher) // block_length
+        if blocks < 2:
+            break  # not enough cypher_text to compare two blocks
+        samples = numpy.frombuffer(bytes(b_cypher[:blocks * block_length]),
+                                   numpy.uint8).reshape(blocks, block_length)
+        hds = hamming_distances(samples[0], samples[1:])
+        normalized_hd = float(hds.mean()) / block_length
         normalized_hamming_distances.append((normalized_hd, key_length))
         if verbose:
-            print("key_length: %d hamming distance: %d normalized_hd: %05f" % (key_length, hd, normalized_hd))
+            print("key_length: %d mean hamming distance over %d blocks: %.1f normalized_hd: %05f"
+                  % (key_length, blocks - 1, hds.mean(), normalized_hd))
     normalized_hamming_distances.sort()
     most_likely_key_length = normalized_hamming_distances[0][1]
     if verbose:
@@ -445,30 +667,108 @@ def compute_hamming_distance(b1, b2, verbose=False):
         1   0  | 1
         1   1  | 0
 
+    Both buffers are read as one big integer each, so the XOR and the count
+    of ones each run once over the whole buffer.
+
     """
     assert len(b1) == len(b2)
-    result = xor_bytes(b1, b2, verbose=verbose)
-    hamming_distance = ones_in_bytes(result, verbose=verbose)
+    hamming_distance = popcount(int.from_bytes(bytes(b1), 'big') ^
+                                int.from_bytes(bytes(b2), 'big'))
+    if verbose:
+        print('hamming distance %d over %d bytes' % (hamming_distance, len(b1)))
     return hamming_distance
 
 
-def solve_single_byte_xor_cypher_on_bytes(b_cypher, verbose=False):
-    ans_plain_text = ""
-    ans_key = ""
-    ans_score = 0.0
-    keys = [ii for ii in range(2 ** 8)] # the key is one of these
-    for key in keys:
-        b_plain_text = bytewize_xor_with_byte_key(b_cypher, key)
-        plain_text = ascii_string_from_bytes(b_plain_text)
-        score = how_english_is_plain_text(plain_text)
-        if score > ans_score:
-            ans_score = score
-            ans_key = key
-            ans_plain_text = plain_text
-            if verbose:
-                print('new_high_score: ', end = "")
-                print(key, score)  #, plain_text)
-    return ans_plain_text, ans_key, ans_score
+def hamming_distances(block, blocks):
+    """
+    Compute the hamming distance between block and each of many blocks.
+
+    block is bytes (or a numpy uint8 array) and blocks is a list of bytes of
+    the same length or a 2-D numpy uint8 array with one block per row.
+    Returns a numpy array with one distance per block.
+
+    """
+    block = numpy.frombuffer(bytes(block), numpy.uint8)
+    if not isinstance(blocks, numpy.ndarray):
+        blocks = numpy.frombuffer(b''.join(blocks), numpy.uint8)
+    blocks = blocks.reshape(-1, len(block))
+    return POPCOUNT_TABLE[blocks ^ block].sum(axis=1, dtype=numpy.int64)
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(n):
+        """
+        Count the binary ones in a non-negative integer of any size.
+
+        """
+        return n.bit_count()
+else:  # before python 3.10
+    def popcount(n):
+        """
+        Count the binary ones in a non-negative integer of any size.
+
+        """
+        return bin(n).count('1')
+
+
+def solve_single_byte_xor_cypher_on_bytes(b_cypher, verbose=False,
+                                          profile=PRINTABLE_PROFILE):
+    """
+    Find the single byte key that makes b_cypher most english.
+
+    XOR with a fixed key only moves each byte value to another, so the plain
+    text byte histogram of every key is a permutation of the cypher text
+    histogram.  With a byte weight profile all 256 keys are scored from one
+    histogram; a quadgram model (see how_english_is_plain_text) rescores the
+    QUADGRAM_SHORTLIST keys LETTER_PROFILE likes best.  Only the winning key
+    is used to decrypt.
+
+    Returns (plain_text, key, score) or ('', '', 0.0) if b_cypher is empty.
+
+    """
+    if len(b_cypher) == 0:
+        return "", "", 0.0
+    if len(profile) == 256:
+        scores = score_single_byte_xor_keys(b_cypher, key_weights(profile))
+    else:
+        # quadgrams do not follow the byte histogram: decrypt a shortlist
+        letter_scores = score_single_byte_xor_keys(b_cypher, LETTER_KEY_WEIGHTS)
+        scores = numpy.full(256, -numpy.inf)
+        for key in numpy.argsort(-letter_scores, kind='mergesort')[:QUADGRAM_SHORTLIST]:
+            scores[key] = how_english_is_plain_text(
+                bytes(b_cypher).translate(XOR_TABLES[key]), profile=profile)
+    key = int(numpy.argmax(scores))  # lowest key wins a tie
+    score = float(scores[key])
+    if verbose:
+        print('new_high_score: ', end = "")
+        print(key, score)
+    plain_text = ascii_string_from_bytes(bytes(b_cypher).translate(XOR_TABLES[key]))
+    return plain_text, key, score
+
+
+def key_weights(profile):
+    """
+    Return the (256, 256) table of the weight byte b gets under key k.
+
+    """
+    if profile is PRINTABLE_PROFILE:
+        return ENGLISH_KEY_WEIGHTS
+    if profile is LETTER_PROFILE:
+        return LETTER_KEY_WEIGHTS
+    return numpy.asarray(profile)[XOR_PERMUTATIONS]
+
+
+def score_single_byte_xor_keys(b_cypher, key_weights=ENGLISH_KEY_WEIGHTS):
+    """
+    Score b_cypher decrypted with every single byte key.
+
+    key_weights[k][b] is the score a cypher byte b earns under key k.  The
+    result is an array of 256 scores: the mean weight per byte for each key.
+
+    """
+    histogram = numpy.bincount(numpy.frombuffer(bytes(b_cypher), numpy.uint8),
+                               minlength=256)
+    return key_weights.dot(histogram) / max(len(b_cypher), 1)
 
 
 def xor_bytes(b1, b2, verbose=False):
@@ -518,9 +818,7 @@ def ones_in_bytes(b, verbose=False):
     Count the binary ones in a bytes object.
 
     """
-    ones = 0
-    for i in b:
-        ones += ones_in_int8(i)
+    ones = popcount(int.from_bytes(bytes(b), 'big'))
 
     if verbose:
         # pprint stuff
@@ -577,22 +875,39 @@ def quote(s):
     return ''.join(['\'', s, '\''])
 
 
-def how_english_is_plain_text(plain_text, verbose=False):
+def how_english_is_plain_text(plain_text, verbose=False,
+                              profile=PRINTABLE_PROFILE):
     """ 
-    score is number of plain_text characters in ENGLISH_CHARS.
+    Score how english plain_text (bytes or a string) looks.
 
-    Input is string, output in integer score.
+    profile is a table of 256 byte weights, scored as the mean weight per
+    byte: PRINTABLE_PROFILE gives the share of characters in ENGLISH_BYTES
+    (0 to 1), LETTER_PROFILE the mean log10 probability of each character.
+    profile may also be an n-gram model from frequencies.load_ngram_model,
+    scored as the mean log10 probability of each n-gram of the letters, or
+    -inf when there are fewer than n letters.  Characters of a string past
+    latin-1 are scored as the unprintable byte 0.
 
     """
-    english_chars = []
-    score = 0
-    for c in plain_text:
-        m = ENGLISH_CHARS.match(c)
-        if m:
-            score += 1
+    if isinstance(plain_text, str):
+        codes = numpy.frombuffer(plain_text.encode('utf-32-le'), numpy.uint32)
+        plain_text = numpy.where(codes > 255, 0, codes).astype(numpy.uint8)
+    if len(profile) == 256:
+        codes = numpy.frombuffer(bytes(plain_text), numpy.uint8)
+        total = numpy.take(profile, codes).sum()
+        count = len(codes)
+        score = float(total) / count if count > 0 else 0.0
+    else:
+        n = int(round(numpy.log(len(profile)) / numpy.log(26)))
+        indexes = frequencies.letter_indexes(bytes(plain_text))
+        count = len(indexes) - n + 1
+        if count > 0:
+            score = float(frequencies.ngram_score(indexes, profile)) / count
+        else:
+            score = float('-inf')
     if verbose:
-        print('is english score %d for %d chars scores %05f.' % (score, len(plain_text), float(score) / len(plain_text)))
-    return float(score) / len(plain_text)
+        print('is english score %05f for %d chars.' % (score, len(plain_text)))
+    return score
 
 
 def bytewize_xor_with_byte_key(b, key):
@@ -657,8 +972,11 @@ def ascii_string_from_bytes(b):
     """
     Recover an ascii string from bytes.
 
+    Each byte becomes the character with the same code, as latin-1 decoding
+    does.
+
     """
-    s = ''.join([chr(c) for c in b])
+    s = bytes(b).decode('latin-1')
     return s
 
 
@@ -680,5 +998,94 @@ def test_bit_counters():
     assert zeros == 0
 
 
+def test_hamming_distance():
+    assert compute_hamming_distance_for_strings(HAMMING_1, HAMMING_2) == \
+        EXPECTED_HAMMING_DISTANCE
+    assert compute_hamming_distance(b'', b'') == 0
+    b1 = bytes_from_ascii_string(HAMMING_1)
+    b2 = bytes_from_ascii_string(HAMMING_2)
+    distances = hamming_distances(b1, [b2, b1, bytes(len(b1))])
+    assert list(distances) == [EXPECTED_HAMMING_DISTANCE, 0, ones_in_bytes(b1)]
+    assert ones_in_bytes(b1) == sum(ones_in_int8(i) for i in b1)
+    # a repeating key xor cypher text reveals its key length
+    text = (b"Now is the time for all good men to come to the aid of the party, "
+            b"and the quick brown fox jumps over the lazy dog while we wait. ") * 4
+    key = b"Terminator X"
+    b_cypher = bytes(b ^ key[ii % len(key)] for ii, b in enumerate(text))
+    assert determine_key_length(b_cypher)[0] % len(key) == 0
+
+
+def test_solve_single_byte_xor():
+    b = bytes_from_hex_string(INPUT_STRING_1_3)
+    plain_text, key, score = solve_single_byte_xor_cypher_on_bytes(b)
+    assert plain_text == "Cooking MC's like a pound of bacon"
+    assert key == 88
+    # agrees with decrypting under every key and scoring each plain text
+    scores = [how_english_is_plain_text(ascii_string_from_bytes(
+        bytewize_xor_with_byte_key(b, k))) for k in range(256)]
+    assert score == max(scores) and key == scores.index(max(scores))
+    assert solve_single_byte_xor_cypher_on_bytes(b'') == ("", "", 0.0)
+
+
+def test_english_profiles():
+    assert how_english_is_plain_text(b"It's 4.5 miles, isn't it?") == 1.0
+    assert how_english_is_plain_text("It's 4.5 miles\x00") == 14.0 / 15
+    assert how_english_is_plain_text("It\u2019s 4.5 miles") == 13.0 / 14
+    text = b"Now is the time for all good men to come to the aid of the party. "
+    b = text.translate(XOR_TABLES[90])
+    model = frequencies.ngram_model_from_words(4)
+    for profile in (PRINTABLE_PROFILE, LETTER_PROFILE, model):
+        english = how_english_is_plain_text(text, profile=profile)
+        assert english > how_english_is_plain_text(b, profile=profile)
+    for profile in (LETTER_PROFILE, model):
+        plain_text, key, _ = solve_single_byte_xor_cypher_on_bytes(b, profile=profile)
+        assert key == 90 and plain_text == text.decode('ascii')
+    assert how_english_is_plain_text(b"the", profile=model) == float('-inf')
+    histogram = frequencies.letter_histogram("Attack")
+    expected = frequencies.log_likelihood(histogram) / 6 + numpy.log10(1 - SPACE_FREQ)
+    assert abs(how_english_is_plain_text(b"Attack", profile=LETTER_PROFILE) - expected) < 1e-9
+    trigrams = frequencies.ngram_model_from_words(3)
+    assert how_english_is_plain_text(b"the", profile=trigrams) > float('-inf')
+
+
+def test_scan_single_byte_xor():
+    import os
+    import random
+    import tempfile
+    plain_text = b"Now that the party is jumping"
+    rng = random.Random(4)
+    lines = [bytes(rng.randrange(256) for _ in range(30)) for _ in range(2000)]
+    lines[1234] = plain_text.translate(XOR_TABLES[53])
+    for encoding, encode in (('hex', base64.b16encode), ('base64', base64.b64encode)):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fdout:
+            fdout.write(b'not a record!\n')
+            fdout.write(b''.join(encode(line) + b'\n' for line in lines))
+        for processes in (1, 2):
+            best = scan_single_byte_xor(filename, encoding, top=3,
+                                        processes=processes, chunk_size=100)
+            assert len(best) == 3
+            score, line_number, key, text, _ = best[0]
+            assert (line_number, key, text) == (1236, 53, plain_text.decode())
+            assert best[0][0] >= best[1][0] >= best[2][0]
+        os.remove(filename)
+    # a memory mapped model reaches the workers by filename
+    fd, model_filename = tempfile.mkstemp(suffix='.npy')
+    with os.fdopen(fd, 'wb') as fdout:
+        numpy.save(fdout, frequencies.ngram_model_from_words(4))
+    model = frequencies.load_ngram_model(model_filename)
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fdout:
+        fdout.write(b''.join(base64.b16encode(line) + b'\n'
+                             for line in lines[1000:1500]))
+    best = scan_single_byte_xor(filename, top=3, processes=2, profile=model,
+                                chunk_size=100)
+    assert best == scan_single_byte_xor(filename, top=3, processes=1,
+                                        profile=model, chunk_size=100)
+    del model
+    os.remove(filename)
+    os.remove(model_filename)
+
+
 if __name__ == '__main__':
     main()
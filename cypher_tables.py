@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+'''cypher_tables.py precompiled translation tables for affine cyphers
+
+Author: Andrew Mattheisen
+
+Every affine cypher maps each letter to exactly one other letter, so the whole
+operation can be expressed as a str.translate/bytes.translate table.  The
+tables for every valid (A, B) key are built once at import time, letting a
+transform run as a single C-level pass over the text.
+
+  Caesarian (ROTx) cyphers are affine cyphers with A = 1, B = x.
+  The Atbash cypher is the affine cypher with A = 25, B = 25.
+
+Letters are upper cased by the tables; all other characters pass through.
+
+'''
+from __future__ import print_function
+import string
+import sys
+
+ALLOWED_A_VALUES=[1,3,5,7,9,11,15,17,19,21,23,25]
+INVERSE_A={
+   1 : 1  ,
+   3 : 9  ,
+   5 : 21 ,
+   7 : 15 ,
+   9 : 3  ,
+  11 : 19 ,
+  15 : 7  ,
+  17 : 23 ,
+  19 : 11 ,
+  21 : 5  ,
+  23 : 17 ,
+  25 : 25 , }
+ATBASH_KEY = (25, 25)
+CHUNK_SIZE = 64 * 1024 # bytes read per pass when streaming
+
+if bytes is str: # python 2: str is bytes, one kind of table serves both
+    _maketrans_str = string.maketrans
+    _maketrans_bytes = string.maketrans
+else:
+    _maketrans_str = str.maketrans
+    _maketrans_bytes = lambda frm, to: bytes.maketrans(
+      frm.encode('ascii'), to.encode('ascii'))
+
+
+def affine_alphabet(a, b, decypher=False):
+    '''Return the 26 uppercase letters that A..Z map to under key (a, b).'''
+    if decypher:
+        a = INVERSE_A[a]
+        return ''.join([chr(((ii - b) * a) % 26 + 65) for ii in range(26)])
+    return ''.join([chr((ii * a + b) % 26 + 65) for ii in range(26)])
+
+
+def _build_tables(maketrans):
+    '''Build encode and decode tables for every (A, B) key.'''
+    from_letters = string.ascii_uppercase + string.ascii_lowercase
+    encode = {}
+    decode = {}
+    for a in ALLOWED_A_VALUES:
+        for b in range(26):
+            alphabet = affine_alphabet(a, b)
+            encode[(a, b)] = maketrans(from_letters, alphabet * 2)
+            alphabet = affine_alphabet(a, b, decypher=True)
+            decode[(a, b)] = maketrans(from_letters, alphabet * 2)
+    return encode, decode
+
+
+def _build_letter_index_table():
+    '''Build a binary table mapping A..Z and a..z to 0..25, all else to 26.'''
+    table = bytearray([26] * 256)
+    for ii in range(26):
+        table[65 + ii] = ii
+        table[97 + ii] = ii
+    return bytes(table)
+
+
+LETTER_INDEX_TABLE = _build_letter_index_table()
+ENCODE_TABLES, DECODE_TABLES = _build_tables(_maketrans_str)
+if bytes is str:
+    BYTES_ENCODE_TABLES, BYTES_DECODE_TABLES = ENCODE_TABLES, DECODE_TABLES
+else:
+    BYTES_ENCODE_TABLES, BYTES_DECODE_TABLES = _build_tables(_maketrans_bytes)
+
+
+def affine_table(a, b, decypher=False, binary=False):
+    '''Return the translate table for affine key (a, b).
+
+    Use binary=True for a table suitable for bytes.translate.'''
+    if binary:
+        tables = BYTES_DECODE_TABLES if decypher else BYTES_ENCODE_TABLES
+    else:
+        tables = DECODE_TABLES if decypher else ENCODE_TABLES
+    return tables[(a, b % 26)]
+
+
+def rot_table(rot, binary=False):
+    '''Return the translate table for a ROTx (Caesarian) cypher.'''
+    return affine_table(1, rot, binary=binary)
+
+
+def atbash_table(binary=False):
+    '''Return the translate table for the Atbash cypher.'''
+    return affine_table(*ATBASH_KEY, binary=binary)
+
+
+def substitution_table(mapping, binary=False):
+    '''Build a translate table from a dict of single characters.'''
+    from_chars = ''.join(sorted(mapping))
+    to_chars = ''.join([mapping[c] for c in sorted(mapping)])
+    if binary:
+        return _maketrans_bytes(from_chars, to_chars)
+    return _maketrans_str(from_chars, to_chars)
+
+
+def transform_words(words, table):
+    '''Apply table to a list of words.
+
+    Returns (cypher_text, clear_text), each word followed by a space.'''
+    cypher_text = ''.join([word + ' ' for word in words])
+    clear_text = cypher_text.translate(table)
+    return cypher_text, clear_text
+
+
+def transform_stream(fdin, fdout, table, chunk_size=CHUNK_SIZE):
+    '''Apply a binary table to everything read from fdin, writing to fdout.
+
+    Text is handled in fixed size chunks so memory use does not depend on the
+    length of the input.  Returns the number of bytes transformed.'''
+    total = 0
+    while True:
+        chunk = fdin.read(chunk_size)
+        if not chunk:
+            break
+        fdout.write(chunk.translate(table))
+        total += len(chunk)
+    return total
+
+
+def transform_file(input_filename, output_filename, table,
+  chunk_size=CHUNK_SIZE):
+    '''Stream input_filename through a binary table into output_filename.
+
+    A filename of '-' (or None for the output) means stdin/stdout.'''
+    fdin = open_binary(input_filename, 'rb')
+    fdout = open_binary(output_filename, 'wb')
+    try:
+        return transform_stream(fdin, fdout, table, chunk_size)
+    finally:
+        if fdin is not _std_binary(sys.stdin):
+            fdin.close()
+        if fdout is _std_binary(sys.stdout):
+            fdout.flush()
+        else:
+            fdout.close()
+
+
+def open_binary(filename, mode):
+    '''Open filename in binary mode, treating '-' and None as stdin/stdout.'''
+    if filename in ('-', None):
+        return _std_binary(sys.stdin if 'r' in mode else sys.stdout)
+    return open(filename, mode)
+
+
+def _std_binary(stream):
+    '''Return the binary layer of a standard stream (python 2 has none).'''
+    return getattr(stream, 'buffer', stream)
+
+
+# =============================================================================
+# TESTS
+# =============================================================================
+def test_affine_table():
+    '''Test function affine_table() against the arithmetic definition.'''
+    for a in ALLOWED_A_VALUES:
+        for b in range(26):
+            for ii in range(26):
+                c = chr(ii + 65)
+                encoded = c.translate(affine_table(a, b))
+                if encoded != chr((ii * a + b) % 26 + 65):
+                    return False # failed
+                if encoded.translate(affine_table(a, b, decypher=True)) != c:
+                    return False # failed
+    return True # passed
+
+
+def test_transform_words():
+    '''Test function transform_words() with the ROT and Atbash tables.'''
+    result = True # start assuming test will pass
+    cypher_text, clear_text = transform_words(['Hello,', 'World!'], rot_table(13))
+    if cypher_text != 'Hello, World! ' or clear_text != 'URYYB, JBEYQ! ':
+        result = False # failed
+    _, clear_text = transform_words(['hello'], atbash_table())
+    if clear_text != 'SVOOL ':
+        result = False # failed
+    if b'abc'.translate(rot_table(1, binary=True)) != b'BCD':
+        result = False # failed
+    if 'ABC!'.translate(substitution_table({'A' : 'x', '!' : '?'})) != 'xBC?':
+        result = False # failed
+    return result
+
+
+def test_transform_stream():
+    '''Test function transform_stream() with a chunk smaller than the text.'''
+    import io
+    text = b'The quick brown fox jumps over the lazy dog. ' * 10
+    fdout = io.BytesIO()
+    table = affine_table(5, 8, binary=True)
+    count = transform_stream(io.BytesIO(text), fdout, table, chunk_size=7)
+    if count != len(text) or fdout.getvalue() != text.translate(table):
+        return False # failed
+    return True # passed
+
+
+def run_tests():
+    '''Run all tests for this file.'''
+    result = "passed" # start assuming tests will pass
+    print("\n"+15*'=', "Testing module %s" % __file__, 15*'=')
+    tests = [
+      (test_affine_table(), "Test affine_table:"),
+      (test_transform_words(), "Test transform_words:"),
+      (test_transform_stream(), "Test transform_stream:"),
+      ]
+    for test in tests:
+        this_result = "passed" if test[0] else "failed"
+        print("%-46s"%test[1], this_result)
+        if not test[0]:
+            result = "failed"
+
+    if result != "passed":
+        print(15*'=',"Result: One or more tests failed.", 15*'=')
+        return False # failed one or more tests
+    print(15*'=', "Result: All tests passed.", 15*'=')
+    return True # passed all tests
+
+
+if __name__ == "__main__":
+    result = run_tests()
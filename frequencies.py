@@ -7,9 +7,33 @@ table data copied from "Secret History: The Story of Cryptography"
 
 '''
 from __future__ import print_function
+import collections
 import json
+import mmap
+import os
+import re
+import string
+import struct
+import subprocess
+import sys
+import numpy
+from cypher_tables import CHUNK_SIZE, LETTER_INDEX_TABLE, open_binary
 
-WORD_PATTERN_FILE = "word_patterns.json"
+WORD_PATTERN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  "word_patterns.json")
+WORD_PATTERN_ENV = "CRYPTO_WORD_PATTERNS" # overrides WORD_PATTERN_FILE
+WORD_FREQUENCY_FILE = os.path.join(os.path.dirname(
+  os.path.abspath(__file__)), "word_frequencies.txt") # optional
+WORD_FREQUENCY_ENV = "CRYPTO_WORD_FREQUENCIES" # overrides WORD_FREQUENCY_FILE
+RANKED_CACHE_SIZE = 4096 # candidate lists kept by each WordLists
+PATTERN_INDEX_SUFFIX = ".idx" # compiled index saved next to the pattern file
+PATTERN_INDEX_MAGIC = b"WPI1"
+PATTERN_INDEX_HEADER = struct.Struct("<4sI")  # magic, number of patterns
+PATTERN_INDEX_ENTRY = struct.Struct("<IIII")  # pattern start, end, words start, end
+QUADGRAM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  "quadgrams.npy")
+PATTERN_CHARS = string.ascii_uppercase
+NGRAM_RUN = re.compile('[A-Za-z0-9]+') # n-grams never span other characters
 
 # Overall Frequency of letters (%)
 letter_freq = {
@@ -90,6 +114,280 @@ double_letter_freq = {
  "bb" :  0.25,
   }
 
+PROFILE_FLOOR = 1e-4 # probability used for letters a profile never saw
+
+
+def _profile(table, key=None):
+    '''Compile a table keyed by lowercase letter (or doubled letter) into a
+    numpy vector of 26 probabilities for A..Z.'''
+    profile = numpy.zeros(26)
+    for letters, value in table.items():
+        profile[ord(letters[0]) - ord('a')] = value if key is None else \
+          value[key]
+    return profile / profile.sum()
+
+
+# numpy versions of the tables above, compiled once
+ENGLISH_LETTER_FREQ = _profile(letter_freq)
+ENGLISH_INITIAL_FREQ = _profile(letter_pos_freq, "initial_pos")
+ENGLISH_TERMINAL_FREQ = _profile(letter_pos_freq, "term_pos")
+ENGLISH_DOUBLE_FREQ = _profile(double_letter_freq)
+ENGLISH_IC = float((ENGLISH_LETTER_FREQ ** 2).sum())
+RANDOM_IC = 1.0 / 26
+
+
+def text_indexes(text):
+    '''Map every character of text to a numpy uint8 array.
+
+    Letters A..Z (ignoring case) become 0..25, everything else becomes 26.'''
+    if not isinstance(text, bytes):
+        text = text.encode('ascii', 'replace')
+    return numpy.frombuffer(text.translate(LETTER_INDEX_TABLE), numpy.uint8)
+
+
+def letter_indexes(text):
+    '''Map the letters of text to a numpy uint8 array of 0..25 (A..Z).
+
+    Characters other than letters are dropped.'''
+    indexes = text_indexes(text)
+    return indexes[indexes < 26]
+
+
+def letter_histogram(text):
+    '''Count each letter A..Z (ignoring case) in text.
+
+    Returns a numpy array of 26 counts.'''
+    return numpy.bincount(text_indexes(text), minlength=27)[:26]
+
+
+def adjacency_matrix(text):
+    '''Count adjacent letter pairs in text in a single pass.
+
+    Returns a 26x26 numpy array where matrix[ii][jj] is the number of times
+    letter ii is directly followed by letter jj.  Pairs separated by anything
+    other than a letter are not counted.  text may also be a text_indexes()
+    array.'''
+    indexes = text if isinstance(text, numpy.ndarray) else text_indexes(text)
+    first = indexes[:-1]
+    second = indexes[1:]
+    is_pair = (first < 26) & (second < 26)
+    pairs = first[is_pair].astype(numpy.intp) * 26 + second[is_pair]
+    return numpy.bincount(pairs, minlength=26 * 26).reshape(26, 26)
+
+
+def chi_squared(histograms, profile=ENGLISH_LETTER_FREQ):
+    '''Chi-squared distance of 26 bin letter histograms from profile.
+
+    histograms is one histogram or an array of them (one per row); returns a
+    float or an array of one score per histogram.  Lower is more alike.'''
+    histograms = numpy.asarray(histograms, dtype=float)
+    totals = numpy.maximum(histograms.sum(axis=-1), 1)
+    expected = numpy.maximum(profile, PROFILE_FLOOR) * \
+      numpy.expand_dims(totals, -1)
+    return ((histograms - expected) ** 2 / expected).sum(axis=-1)
+
+
+def log_likelihood(histograms, profile=ENGLISH_LETTER_FREQ):
+    '''log10 probability of the letters counted by histograms under profile.
+
+    Works on one histogram or an array of them like chi_squared().  Higher is
+    more alike.'''
+    histograms = numpy.asarray(histograms, dtype=float)
+    return histograms.dot(numpy.log10(numpy.maximum(profile, PROFILE_FLOOR)))
+
+
+def index_of_coincidence(histograms):
+    '''Chance that two letters drawn from the histogram are the same.
+
+    Works on one histogram or an array of them like chi_squared().  English
+    text scores about ENGLISH_IC and uniformly random letters RANDOM_IC; a
+    substitution cypher keeps the index of its plaintext.'''
+    histograms = numpy.asarray(histograms, dtype=float)
+    totals = histograms.sum(axis=-1)
+    pairs = numpy.maximum(totals * (totals - 1), 1)
+    return (histograms * (histograms - 1)).sum(axis=-1) / pairs
+
+
+def letter_indexes_file(filename, chunk_size=CHUNK_SIZE):
+    '''Yield letter_indexes() arrays for a file ('-' for stdin) in chunks.'''
+    fdin = open_binary(filename, 'rb')
+    try:
+        while True:
+            chunk = fdin.read(chunk_size)
+            if not chunk:
+                break
+            yield letter_indexes(chunk)
+    finally:
+        if filename != '-':
+            fdin.close()
+
+
+def letter_histogram_file(filename, chunk_size=CHUNK_SIZE):
+    '''Count each letter A..Z in a file ('-' for stdin), reading in chunks.'''
+    histogram = numpy.zeros(26, numpy.int64)
+    fdin = open_binary(filename, 'rb')
+    try:
+        while True:
+            chunk = fdin.read(chunk_size)
+            if not chunk:
+                break
+            histogram += letter_histogram(chunk)
+    finally:
+        if filename != '-':
+            fdin.close()
+    return histogram
+
+
+class NGramCounter(object):
+    '''Count n-grams of several sizes in one sliding window pass.
+
+    Text may be fed in pieces with update(); n-grams spanning two pieces are
+    counted once.  Only runs of letters and digits are counted, so an n-gram
+    never contains a space or punctuation.  counts maps each size to a
+    collections.Counter of its n-grams.'''
+
+    def __init__(self, sizes=(2, 3)):
+        self.sizes = sorted(set(sizes))
+        self.counts = dict([(n, collections.Counter()) for n in self.sizes])
+        self._tail = '' # end of the last piece, if it ended inside a run
+
+    def update(self, text):
+        '''Count the n-grams in the next piece of text.'''
+        tail = ''
+        for match in NGRAM_RUN.finditer(text):
+            run = match.group()
+            seen = 0 # leading chars of run already counted with the last piece
+            if match.start() == 0 and self._tail:
+                seen = len(self._tail)
+                run = self._tail + run
+            for n in self.sizes:
+                self.counts[n].update([run[ii:ii + n] for ii in
+                  range(max(0, seen - n + 1), len(run) - n + 1)])
+            if match.end() == len(text):
+                tail = run[max(0, len(run) - self.sizes[-1] + 1):]
+        if text:
+            self._tail = tail
+        return self
+
+    def most_common(self, n, k=None):
+        '''Return the k most common n-grams of size n with their counts.'''
+        return self.counts[n].most_common(k)
+
+
+def count_ngrams(text, sizes=(2, 3)):
+    '''Count the n-grams of each size in sizes in text.'''
+    return NGramCounter(sizes).update(text)
+
+
+def count_ngrams_file(filename, sizes=(2, 3), chunk_size=CHUNK_SIZE):
+    '''Count the n-grams of each size in a file ('-' for stdin) in chunks.'''
+    counter = NGramCounter(sizes)
+    fdin = open_binary(filename, 'rb')
+    try:
+        while True:
+            chunk = fdin.read(chunk_size)
+            if not chunk:
+                break
+            if not isinstance(chunk, str):
+                chunk = chunk.decode('latin-1')
+            counter.update(chunk)
+    finally:
+        if filename != '-':
+            fdin.close()
+    return counter
+
+
+def ngram_indexes(indexes, n):
+    '''Pack every window of n letter indexes into one base 26 integer.
+
+    indexes is a letter_indexes() array; the result has one entry per window
+    and can index a 26**n array such as ngram_log_probabilities().'''
+    count = max(len(indexes) - n + 1, 0)
+    packed = numpy.zeros(count, numpy.intp)
+    for k in range(n):
+        packed = packed * 26 + indexes[k:k + count]
+    return packed
+
+
+def ngram_histogram(text, n, span_gaps=True):
+    '''Count the letter n-grams of text into a numpy array of 26**n counts.
+
+    With span_gaps, everything but letters is dropped first so n-grams run
+    across word breaks, as they do in a cyphertext without spaces.  Otherwise
+    n-grams containing anything but letters are skipped.'''
+    indexes = text_indexes(text)
+    if span_gaps:
+        packed = ngram_indexes(indexes[indexes < 26], n)
+    else:
+        packed = ngram_indexes(indexes, n)
+        gaps = numpy.concatenate(([0], numpy.cumsum(indexes == 26)))
+        packed = packed[gaps[n:] == gaps[:len(packed)]]
+    return numpy.bincount(packed, minlength=26 ** n)
+
+
+def ngram_histogram_file(filename, n, chunk_size=CHUNK_SIZE):
+    '''ngram_histogram() of a file ('-' for stdin), reading it in chunks.'''
+    histogram = numpy.zeros(26 ** n, numpy.int64)
+    carry = numpy.zeros(0, numpy.uint8) # last n-1 letters of the last chunk
+    for letters in letter_indexes_file(filename, chunk_size):
+        letters = numpy.concatenate((carry, letters))
+        histogram += numpy.bincount(ngram_indexes(letters, n),
+          minlength=26 ** n)
+        carry = letters[max(len(letters) - n + 1, 0):]
+    return histogram
+
+
+def ngram_log_probabilities(histogram, floor=0.01):
+    '''Turn an ngram_histogram() into log10 n-gram probabilities.
+
+    Returns a numpy float32 array of the same 26**n length.  n-grams never
+    seen get the probability of floor sightings.'''
+    totals = numpy.asarray(histogram, dtype=float)
+    total = max(totals.sum(), 1)
+    totals = numpy.where(totals == 0, floor, totals)
+    return numpy.log10(totals / total).astype(numpy.float32)
+
+
+def build_quadgram_model(corpus_filename, model_filename=QUADGRAM_FILE):
+    '''Build a quadgram model from a plain text corpus and save it.
+
+    The model is a 26**4 float32 array of log10 probabilities (under 2 MB)
+    saved in numpy .npy format so load_ngram_model() can memory map it.'''
+    model = ngram_log_probabilities(ngram_histogram_file(corpus_filename, 4))
+    with open(model_filename, 'wb') as fdout:
+        numpy.save(fdout, model)
+    return model
+
+
+def load_ngram_model(filename=QUADGRAM_FILE):
+    '''Memory map a model saved by build_quadgram_model().
+
+    Nothing is parsed or copied: pages are read on first use and are shared
+    by every process that maps the same file.'''
+    return numpy.load(filename, mmap_mode='r')
+
+
+def ngram_score(text, model):
+    '''Sum the model log probabilities of every n-gram in the letters of text.
+
+    text may also be a letter_indexes() array.  n is taken from the size of
+    the model.'''
+    n = int(round(numpy.log(len(model)) / numpy.log(26)))
+    indexes = text if isinstance(text, numpy.ndarray) else letter_indexes(text)
+    return float(model[ngram_indexes(indexes, n)].sum())
+
+
+def ngram_model_from_words(n=4, patterns=None):
+    '''Build an n-gram model from every word in the patterns dictionary.
+
+    Only n-grams inside a word are counted, and each word counts once however
+    common it is, so a model built from a corpus of real text with
+    ngram_histogram_file() scores much better.'''
+    if patterns is None:
+        patterns = default_patterns()
+    text = ' '.join([' '.join(words) for words in patterns.values()])
+    return ngram_log_probabilities(ngram_histogram(text, n, span_gaps=False))
+
 
 def write_pattern_file(patterns, filename):
     '''Write patterns dictionary to json file.'''
@@ -98,61 +396,282 @@ def write_pattern_file(patterns, filename):
     return
 
 
-def read_pattern_file(filename=WORD_PATTERN_FILE):
-    '''Create patterns dictionary from json file.'''
+def word_pattern_file():
+    '''Return the words list pattern file, honouring $CRYPTO_WORD_PATTERNS.'''
+    return os.environ.get(WORD_PATTERN_ENV) or WORD_PATTERN_FILE
+
+
+_default_patterns = None # loaded by default_patterns() on first use
+
+
+def default_patterns():
+    '''Return the patterns dictionary of the words list.
+
+    The pattern file is read the first time this is called and the result is
+    shared by the whole process.  A PatternIndex is used instead when the
+    pattern file is one, or when build_pattern_index() has saved one next to
+    it since the pattern file last changed.'''
+    global _default_patterns
+    if _default_patterns is None:
+        filename = word_pattern_file()
+        index_filename = os.path.splitext(filename)[0] + PATTERN_INDEX_SUFFIX
+        if is_pattern_index(filename):
+            _default_patterns = PatternIndex(filename)
+        elif (os.path.exists(index_filename) and
+          os.path.getmtime(index_filename) >= os.path.getmtime(filename)):
+            _default_patterns = PatternIndex(index_filename)
+        else:
+            _default_patterns = read_pattern_file(filename)
+    return _default_patterns
+
+
+def read_pattern_file(filename=None):
+    '''Create patterns dictionary from json file.
+
+    filename defaults to word_pattern_file().'''
+    if filename is None:
+        filename = word_pattern_file()
     with open(filename, 'r') as fdin:
         patterns = json.load(fdin)
-    for pattern in patterns:
-        for position,word in enumerate(patterns[pattern]):
-            patterns[pattern][position] = str(word) # string please, no unicode
+    if bytes is str: # python 2 json gives unicode
+        for pattern in patterns:
+            for position,word in enumerate(patterns[pattern]):
+                patterns[pattern][position] = str(word) # string please, no unicode
     return patterns
 
 
+def write_pattern_index(patterns, filename):
+    '''Write patterns dictionary to a binary PatternIndex file.
+
+    The file is a header, a table of fixed size entries sorted by pattern and
+    a blob holding each pattern followed by its sorted words, one per line.'''
+    keys = sorted([pattern.encode('ascii') for pattern in patterns])
+    blob = []
+    entries = []
+    offset = PATTERN_INDEX_HEADER.size + len(keys) * PATTERN_INDEX_ENTRY.size
+    for key in keys:
+        words = '\n'.join(sorted(set(patterns[key.decode('ascii')])))
+        words = words.encode('utf-8')
+        entries.append(PATTERN_INDEX_ENTRY.pack(offset, offset + len(key),
+          offset + len(key), offset + len(key) + len(words)))
+        blob.append(key + words)
+        offset += len(key) + len(words)
+    with open(filename, 'wb') as fdout:
+        fdout.write(PATTERN_INDEX_HEADER.pack(PATTERN_INDEX_MAGIC, len(keys)))
+        fdout.write(b''.join(entries))
+        fdout.write(b''.join(blob))
+    return
+
+
+def build_pattern_index(source_filename=None, index_filename=None):
+    '''Compile a pattern file (.json) or a word list into a PatternIndex file.
+
+    source_filename defaults to word_pattern_file() and index_filename to the
+    source with a .idx extension, where default_patterns() looks for it.'''
+    if source_filename is None:
+        source_filename = word_pattern_file()
+    if index_filename is None:
+        index_filename = os.path.splitext(source_filename)[0] + \
+          PATTERN_INDEX_SUFFIX
+    if source_filename.endswith('.json'):
+        patterns = read_pattern_file(source_filename)
+    else:
+        patterns = create_word_patterns(source_filename)
+    write_pattern_index(patterns, index_filename)
+    return index_filename
+
+
+def rewrite_pattern_index(index, patterns):
+    '''Replace the file of PatternIndex index with patterns; return a new
+    PatternIndex of it.
+
+    The new file is written alongside and renamed over the old one, so index
+    and any other process mapping it keep reading the old words.'''
+    new_filename = index.filename + ".new"
+    write_pattern_index(patterns, new_filename)
+    os.rename(new_filename, index.filename)
+    return PatternIndex(index.filename)
+
+
+def is_pattern_index(filename):
+    '''Return True if filename was written by write_pattern_index().'''
+    with open(filename, 'rb') as fdin:
+        return fdin.read(len(PATTERN_INDEX_MAGIC)) == PATTERN_INDEX_MAGIC
+
+
+class PatternIndex(object):
+    '''Read only patterns dictionary backed by a memory mapped index file.
+
+    Opening the index parses nothing: a lookup is a binary search of the
+    sorted pattern table, and only the words of the pattern found are decoded.
+    Every process that opens the same file shares its pages.  Supports the
+    dictionary operations the rest of this module uses on patterns.'''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fdin:
+            self.map = mmap.mmap(fdin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = PATTERN_INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != PATTERN_INDEX_MAGIC:
+            raise ValueError("%s is not a pattern index" % filename)
+        self.filename = filename
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pattern):
+        return self._find(pattern) is not None
+
+    def __getitem__(self, pattern):
+        entry = self._find(pattern)
+        if entry is None:
+            raise KeyError(pattern)
+        return self._words(entry)
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, pattern, default=None):
+        entry = self._find(pattern)
+        return default if entry is None else self._words(entry)
+
+    def keys(self):
+        for ii in range(self.count):
+            start, end, _, _ = self._entry(ii)
+            key = self.map[start:end]
+            yield key if bytes is str else key.decode('ascii')
+
+    def values(self):
+        for ii in range(self.count):
+            yield self._words(self._entry(ii))
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def close(self):
+        self.map.close()
+
+    def _entry(self, ii):
+        return PATTERN_INDEX_ENTRY.unpack_from(self.map,
+          PATTERN_INDEX_HEADER.size + ii * PATTERN_INDEX_ENTRY.size)
+
+    def _find(self, pattern):
+        '''Binary search the pattern table, returning the entry or None.'''
+        key = pattern.encode('ascii')
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            entry = self._entry(mid)
+            found = self.map[entry[0]:entry[1]]
+            if found == key:
+                return entry
+            if found < key:
+                low = mid + 1
+            else:
+                high = mid
+        return None
+
+    def _words(self, entry):
+        words = self.map[entry[2]:entry[3]]
+        if bytes is not str:
+            words = words.decode('utf-8')
+        return words.split('\n')
+
+
 def create_word_patterns(word_list_filename, verbose=False):
     '''Create a dictionary of word patterns from a word file.'''
-    letters = ['a','b','c','d','e','f','g','h','i','j','k','l','m','n',
-      'o','p','q','r','s','t','u','v','w','x','y','z'] 
     with open(word_list_filename, 'r') as fd:
-        patterns = {}
-        for line in fd:
-            word = line.strip().lower()
-            if word[-1] == "%":
-                # skip uncountable plurals
-                continue
-            if word[0] in letters:
-                letters.remove(word[0])
-                if verbose:
-                    print("update: found first word starting with %s" % word[0])
-            pattern = get_pattern(word)
-            if not pattern in patterns.keys():
-                patterns[pattern] = []
-            if not word in patterns[pattern]:
-                patterns[pattern].append(word)
+        return add_words({}, fd, verbose)
+
+
+def add_words(patterns, words, verbose=False):
+    '''Add words (any iterable, such as an open word file) to patterns.
+
+    patterns is updated in place and returned; each list of words stays sorted
+    and free of duplicates.  Words are lower cased and uncountable plurals
+    (words ending in %) are skipped.  A PatternIndex is read only, so its file
+    is rewritten instead and a new PatternIndex of it is returned.'''
+    if isinstance(patterns, PatternIndex):
+        return rewrite_pattern_index(patterns,
+          add_words(dict(patterns.items()), words, verbose))
+    unique_words = set()
+    initials = set()
+    for line in words:
+        word = line.strip().lower()
+        if not word or word[-1] == "%":
+            # skip blank lines and uncountable plurals
+            continue
+        if verbose and word[0] not in initials:
+            initials.add(word[0])
+            print("update: found first word starting with %s" % word[0])
+        unique_words.add(word)
+    new_words = {}
+    for word, pattern in zip(unique_words, get_patterns(unique_words)):
+        new_words.setdefault(pattern, set()).add(word)
+    for pattern, pattern_words in new_words.items():
+        pattern_words.update(patterns.get(pattern, []))
+        patterns[pattern] = sorted(pattern_words)
+    return patterns
+
+
+def remove_words(patterns, words):
+    '''Remove words from patterns in place, dropping emptied patterns.
+
+    Like add_words(), a PatternIndex has its file rewritten and a new
+    PatternIndex is returned.'''
+    if isinstance(patterns, PatternIndex):
+        return rewrite_pattern_index(patterns,
+          remove_words(dict(patterns.items()), words))
+    words = set([word.strip().lower() for word in words]) - set([''])
+    old_words = {}
+    for word, pattern in zip(words, get_patterns(words)):
+        old_words.setdefault(pattern, set()).add(word)
+    for pattern, pattern_words in old_words.items():
+        if pattern not in patterns:
+            continue
+        remaining = [word for word in patterns[pattern]
+          if word not in pattern_words]
+        if remaining:
+            patterns[pattern] = remaining
+        else:
+            del patterns[pattern]
     return patterns
 
 
 def get_pattern(word):
     '''Determine the pattern for a word.'''
     # ASSUME: no more than 26 unique chars in a word
-    PATTERN_CHARS = ['A','B','C','D','E','F','G','H','I','J','K','L','M','N',
-      'O','P','Q','R','S','T','U','V','W','X','Y','Z'] 
     # ASSUME: no distinction between uppercase and lowercase
     word = word.lower()
-    # determine chars in word
-    chars = []
+    # each char becomes the pattern char of the order it first appears in
+    codes = {}
     for char in word:
-        if not char.lower() in chars:
-            chars.append(char)
-    # create pattern
-    pattern = word
-    for char_index, char in enumerate(chars):
-        pattern = pattern.replace(char,PATTERN_CHARS[char_index])
-    return pattern    
+        if char not in codes:
+            codes[char] = PATTERN_CHARS[len(codes)]
+    return ''.join([codes[char] for char in word])
 
 
-def get_words_for_pattern(pattern, patterns=read_pattern_file(WORD_PATTERN_FILE)):
+def get_patterns(words, memo=None):
+    '''Determine the pattern of every word in an iterable of words.
+
+    Returns a list of patterns in the same order.  Each distinct word is
+    patterned once; pass the same memo dictionary to several calls to share
+    that work between them.'''
+    if memo is None:
+        memo = {}
+    patterns = []
+    for word in words:
+        pattern = memo.get(word)
+        if pattern is None:
+            pattern = memo[word] = get_pattern(word)
+        patterns.append(pattern)
+    return patterns
+
+
+def get_words_for_pattern(pattern, patterns=None):
     '''Retieve all words matching pattern from patterns.
     The default patterns is all words in the english language'''
+    if patterns is None:
+        patterns = default_patterns()
     words = []
     for word in patterns[pattern]:
         words.append(word)
@@ -167,31 +686,400 @@ def filter_words(words, indexes, chars, verbose=False):
         indexes = [indexes]
     if type(chars) != type([]):
         chars = [chars]
-    filtered_words = []
-    for word in words:
-        if word[indexes[0]] == chars[0]:
-            filtered_words.append(word)
-    if len(indexes) != 1:
-        # multi-character guess
-        for ii in range(1,len(indexes)):
-            for word in filtered_words:
-                if not word[indexes[ii]] == chars[ii]:
-                    filtered_words.remove(word)
+    known = list(zip(indexes, chars))
+    filtered_words = [word for word in words
+      if all([word[index] == char for index, char in known])]
     if verbose:
         print("wordlist reduced from %d to %d words" % (
           len(words), len(filtered_words) ) )
     return filtered_words
 
 
+_position_indexes = {} # PositionIndex of each pattern of default_patterns()
+
+
+def get_position_index(pattern, patterns=None):
+    '''Return a PositionIndex of the words matching pattern.
+
+    The words keep the order patterns gives them, so with a WordLists the
+    word ids run from most to least likely.  Indexes of default_wordlists()
+    are built once and kept for the life of the process.  Raises KeyError if
+    no word has the pattern.'''
+    if patterns is not None:
+        return PositionIndex(patterns[pattern])
+    if pattern not in _position_indexes:
+        _position_indexes[pattern] = PositionIndex(default_wordlists()[pattern])
+    return _position_indexes[pattern]
+
+
+class PositionIndex(object):
+    '''Bitsets of the words that have each letter at each position.
+
+    Word ids are positions in the words list, and a set of words is an int
+    with bit id set for each word in it.  masks[(position, letter)] holds the
+    words with letter at position, so filtering on any number of known letters
+    is a few int ANDs whatever the number of words.'''
+
+    def __init__(self, words):
+        self.words = list(words)
+        self.all = (1 << len(self.words)) - 1
+        self.masks = {}
+        for position in range(max([len(word) for word in self.words] + [0])):
+            column = [word[position] if position < len(word) else ''
+              for word in self.words]
+            for letter in set(column) - set(['']):
+                # bit string with word 0 last, so int() puts it at bit 0
+                bits = ['1' if c == letter else '0' for c in reversed(column)]
+                self.masks[(position, letter)] = int(''.join(bits), 2)
+
+    def __len__(self):
+        return len(self.words)
+
+    def match(self, indexes, chars, mask=None):
+        '''Return mask (default all words) less words without chars at indexes.'''
+        if mask is None:
+            mask = self.all
+        for index, char in zip(indexes, chars):
+            mask &= self.masks.get((index, char), 0)
+        return mask
+
+    def exclude(self, indexes, chars, mask=None):
+        '''Return mask (default all words) less words with any of chars at any
+        of indexes.'''
+        if mask is None:
+            mask = self.all
+        for index in indexes:
+            for char in chars:
+                mask &= ~self.masks.get((index, char), 0)
+        return mask
+
+    def select(self, mask):
+        '''Return the words in mask, in words list order.'''
+        words = []
+        while mask:
+            low = mask & -mask
+            words.append(self.words[low.bit_length() - 1])
+            mask ^= low
+        return words
+
+    def filter(self, indexes, chars):
+        '''Return the words with chars at indexes, like filter_words().'''
+        if type(indexes) != type([]):
+            indexes = [indexes]
+        if type(chars) != type([]):
+            chars = [chars]
+        return self.select(self.match(indexes, chars))
+
+
+_word_tries = {} # WordTrie of each pattern of default_patterns()
+
+
+def get_word_trie(pattern, patterns=None):
+    '''Return a WordTrie of the words matching pattern.
+
+    Tries of the default patterns are built once and kept for the life of the
+    process.  Raises KeyError if no word has the pattern.'''
+    if patterns is not None:
+        return WordTrie(patterns[pattern])
+    if pattern not in _word_tries:
+        _word_tries[pattern] = WordTrie(default_patterns()[pattern])
+    return _word_tries[pattern]
+
+
+def query_words(cypher_word, mapping=None, patterns=None):
+    '''Yield the words cypher_word can decode to, given a partial mapping.
+
+    mapping maps cypherchars to the plainchars already known for them.  The
+    words yielded have cypher_word's pattern, agree with mapping and do not
+    reuse a plainchar that mapping gives to another cypherchar.'''
+    try:
+        trie = get_word_trie(get_pattern(cypher_word), patterns)
+    except KeyError:
+        return iter([]) # no words share this pattern
+    return trie.query(cypher_word, mapping)
+
+
+class WordTrie(object):
+    '''Prefix tree of a words list that answers partial mapping queries.
+
+    Each node is [word ending here or None, [(letter, child), ...]] with the
+    children in alphabetical order.'''
+
+    def __init__(self, words):
+        self.root = [None, []]
+        for word in sorted(set(words)):
+            node = self.root
+            for letter in word:
+                children = node[1]
+                # words arrive sorted, so a shared prefix is always the last child
+                if not children or children[-1][0] != letter:
+                    children.append((letter, [None, []]))
+                node = children[-1][1]
+            node[0] = word
+
+    def query(self, cypher_word, mapping=None):
+        '''Lazily yield, in alphabetical order, the words cypher_word can
+        decode to.
+
+        Each cypherchar is bound to a plainchar the first time the descent
+        meets it and must decode the same way wherever it repeats; a plainchar
+        can only be bound to one cypherchar.  mapping (cypherchar ->
+        plainchar) gives bindings known up front.'''
+        bound = dict(mapping or {})
+        used = set(bound.values())
+        return self._query(self.root, cypher_word, 0, bound, used)
+
+    def _query(self, node, cypher_word, position, bound, used):
+        if position == len(cypher_word):
+            if node[0] is not None:
+                yield node[0]
+            return
+        cypher = cypher_word[position]
+        plain = bound.get(cypher)
+        for letter, child in node[1]:
+            if plain is not None:
+                if letter != plain:
+                    continue
+                for word in self._query(child, cypher_word, position + 1,
+                  bound, used):
+                    yield word
+                break
+            if letter in used:
+                continue
+            bound[cypher] = letter
+            used.add(letter)
+            for word in self._query(child, cypher_word, position + 1, bound,
+              used):
+                yield word
+            del bound[cypher]
+            used.discard(letter)
+
+
+def read_word_list(filename):
+    '''Read a word file with an optional count after each word.
+
+    Returns (patterns, counts) where counts maps each word to its count, or is
+    None if no line has one.'''
+    words = []
+    counts = {}
+    with open(filename, 'r') as fd:
+        for line in fd:
+            fields = line.split()
+            if not fields:
+                continue
+            word = fields[0].lower()
+            words.append(word)
+            if len(fields) > 1:
+                counts[word] = counts.get(word, 0) + float(fields[1])
+    return add_words({}, words), counts or None
+
+
+def read_word_frequencies(filename=None):
+    '''Read word counts ("word count" lines) into a dictionary.
+
+    filename defaults to $CRYPTO_WORD_FREQUENCIES or WORD_FREQUENCY_FILE.
+    Returns None if the file does not exist.'''
+    if filename is None:
+        filename = os.environ.get(WORD_FREQUENCY_ENV) or WORD_FREQUENCY_FILE
+    if not os.path.exists(filename):
+        return None
+    return read_word_list(filename)[1]
+
+
+_default_wordlists = None # built by default_wordlists() on first use
+
+
+def default_wordlists():
+    '''Return the WordLists of the words list, ranked by the word frequencies
+    file if there is one.'''
+    global _default_wordlists
+    if _default_wordlists is None:
+        _default_wordlists = WordLists()
+        _default_wordlists.add(default_patterns(), read_word_frequencies(),
+          name='words list')
+    return _default_wordlists
+
+
+class WordLists(object):
+    '''Several words lists whose candidates come back most likely first.
+
+    Each list is a patterns dictionary with optional word counts and a weight.
+    A word's score is the sum over the lists that contain it of weight times
+    its probability in that list: count / total count, with words the counts
+    leave out counted once, or 1 / number of words when a list has no counts.
+    Ties are broken alphabetically.  Results of candidates() are kept in an
+    LRU cache of cache_size entries.
+
+    Indexing a WordLists with a pattern gives the ranked candidates, so it can
+    be used wherever a patterns dictionary is expected.'''
+
+    def __init__(self, cache_size=RANKED_CACHE_SIZE):
+        self.lists = []
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def add(self, patterns, counts=None, weight=1.0, name=None):
+        '''Add a patterns dictionary with optional word counts.'''
+        total = float(sum(counts.values())) if counts else None
+        self.lists.append({'name' : name, 'patterns' : patterns,
+          'counts' : counts, 'total' : total, 'weight' : weight})
+        self.cache.clear()
+        return
+
+    def __contains__(self, pattern):
+        return any([pattern in wordlist['patterns']
+          for wordlist in self.lists])
+
+    def __getitem__(self, pattern):
+        words = self.candidates(pattern)
+        if not words:
+            raise KeyError(pattern)
+        return words
+
+    def candidates(self, pattern, known=()):
+        '''Return the words with pattern and the known (position, letter)
+        pairs, most likely first.'''
+        key = (pattern, tuple(sorted(known)))
+        try:
+            words = self.cache.pop(key)
+        except KeyError:
+            if known:
+                words = [word for word in self.candidates(pattern)
+                  if all([word[index] == char for index, char in known])]
+            else:
+                words = self._rank(pattern)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False) # least recently used
+        self.cache[key] = words
+        return words
+
+    def _rank(self, pattern):
+        scores = {}
+        for wordlist in self.lists:
+            words = wordlist['patterns'].get(pattern, [])
+            counts = wordlist['counts']
+            if counts is None:
+                if wordlist['total'] is None:
+                    wordlist['total'] = float(sum([len(v) for v in
+                      wordlist['patterns'].values()]))
+                for word in words:
+                    scores[word] = scores.get(word, 0) + \
+                      wordlist['weight'] / wordlist['total']
+            else:
+                for word in words:
+                    scores[word] = scores.get(word, 0) + wordlist['weight'] * \
+                      counts.get(word, 1) / wordlist['total']
+        return sorted(scores, key=lambda word: (-scores[word], word))
+
+
 # =============================================================================
 # TESTS
 # =============================================================================
 def test_get_pattern():
     '''Test function get_pattern().'''
     test_pattern = get_pattern("AarDvarK")
-    if test_pattern == "AABCDABE":
-        return True # passed
-    return False # failed
+    if test_pattern != "AABCDABE":
+        return False # failed
+    memo = {}
+    patterns = get_patterns(["that", "cypher", "that", "ab'a"], memo)
+    if patterns != ["ABCA", "ABCDEF", "ABCA", "ABCA"] or len(memo) != 3:
+        return False # failed
+    return True # passed
+
+
+def test_letter_histogram():
+    '''Test functions letter_histogram() and letter_indexes().'''
+    histogram = letter_histogram("AarDvarK, 42!")
+    expected = [3, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0,
+      1, 0, 0, 0, 0]
+    if list(histogram) != expected:
+        return False # failed
+    if list(letter_indexes("AarDvarK, 42!")) != [0, 0, 17, 3, 21, 0, 17, 10]:
+        return False # failed
+    return True # passed
+
+
+def test_scorers():
+    '''Test functions chi_squared(), log_likelihood(), index_of_coincidence().'''
+    english = letter_histogram("the quick brown fox jumps over the lazy dog "
+      "and then it sleeps all through a long and dreary afternoon")
+    shifted = numpy.roll(english, 3)
+    batch = numpy.array([english, shifted])
+    chi2 = chi_squared(batch)
+    if not chi2[0] < chi2[1] or chi_squared(english) != chi2[0]:
+        return False # failed
+    likelihood = log_likelihood(batch)
+    if not likelihood[0] > likelihood[1]:
+        return False # failed
+    if abs(index_of_coincidence([2, 2] + [0] * 24) - 1.0 / 3) > 1e-9:
+        return False # failed
+    if index_of_coincidence(batch)[1] != index_of_coincidence(english):
+        return False # failed
+    if abs(ENGLISH_LETTER_FREQ.sum() - 1) > 1e-9 or ENGLISH_DOUBLE_FREQ[11] != \
+      ENGLISH_DOUBLE_FREQ.max():
+        return False # failed
+    return True # passed
+
+
+def test_adjacency_matrix():
+    '''Test function adjacency_matrix().'''
+    matrix = adjacency_matrix("abab c-a")
+    if matrix[0][1] != 2 or matrix[1][0] != 1 or matrix.sum() != 3:
+        return False # failed
+    return True # passed
+
+
+def test_ngram_counter():
+    '''Test class NGramCounter, feeding text whole and in pieces.'''
+    text = "the cat, the hat; thethe"
+    expected = collections.Counter({'th' : 4, 'he' : 4, 'ca' : 1, 'at' : 2,
+      'ha' : 1, 'et' : 1})
+    counter = count_ngrams(text, sizes=(2, 3, 4))
+    if counter.counts[2] != expected or counter.counts[4]['thet'] != 1:
+        return False # failed
+    if counter.most_common(3, 1) != [('the', 4)]:
+        return False # failed
+    pieces = NGramCounter(sizes=(2, 3, 4))
+    for ii in range(0, len(text), 3):
+        pieces.update(text[ii:ii + 3])
+    for n in (2, 3, 4):
+        if pieces.counts[n] != counter.counts[n]:
+            return False # failed
+    return True # passed
+
+
+def test_ngram_log_probabilities():
+    '''Test functions ngram_histogram() and ngram_log_probabilities().'''
+    indexes = ngram_indexes(letter_indexes("THEN"), 2)
+    if list(indexes) != [19 * 26 + 7, 7 * 26 + 4, 4 * 26 + 13]:
+        return False # failed
+    # th and he are each 3 of the 8 bigrams inside words, en is 1 of 8
+    histogram = ngram_histogram("the then, thee", 2, span_gaps=False)
+    model = ngram_log_probabilities(histogram)
+    expected = numpy.log10([3 / 8.0, 3 / 8.0, 1 / 8.0])
+    if histogram.sum() != 8 or not numpy.allclose(model[indexes], expected):
+        return False # failed
+    if model[0] >= model[indexes].min():
+        return False # failed - unseen bigram scored as well as a seen one
+    # across word breaks there are also et and nt
+    if ngram_histogram("the then, thee", 2).sum() != 10:
+        return False # failed
+    return True # passed
+
+
+def test_ngram_model_file():
+    '''Test functions build_quadgram_model(), load_ngram_model(), ngram_score().'''
+    corpus_filename = "test_word_list.txt"
+    model_filename = "quadgrams_test_word_list.npy"
+    model = build_quadgram_model(corpus_filename, model_filename)
+    loaded = load_ngram_model(model_filename)
+    if not isinstance(loaded, numpy.memmap) or not numpy.array_equal(model,
+      loaded):
+        return False # failed
+    result = ngram_score("fruit", loaded) > ngram_score("zqxjv", loaded)
+    del loaded # release the memory map before removing the file
+    os.remove(model_filename)
+    return result
 
 
 def test_create_word_patterns_list():
@@ -225,6 +1113,20 @@ def test_create_word_patterns_list():
     return True
 
 
+def test_add_remove_words():
+    '''Test functions add_words() and remove_words().'''
+    patterns = create_word_patterns("test_word_list.txt")
+    add_words(patterns, ['Kiwi\n', 'lime', 'the', 'uncountables%'])
+    if patterns["ABCD"] != ['lime', 'more'] or patterns["ABCB"] != ['kiwi']:
+        return False # failed
+    if patterns["ABC"].count('the') != 1:
+        return False # failed
+    remove_words(patterns, ['kiwi', 'more', 'absent'])
+    if "ABCB" in patterns or patterns["ABCD"] != ['lime']:
+        return False # failed
+    return True # passed
+
+
 def test_read_write():
     '''Test function write_pattern_file() and read_pattern_file().'''
     filename = "patterns_test_word_list.txt.json"
@@ -243,6 +1145,78 @@ def test_read_write():
     return True # passed
 
 
+def test_pattern_index():
+    '''Test functions build_pattern_index() and PatternIndex.'''
+    filename = build_pattern_index("test_word_list.txt",
+      "patterns_test_word_list.txt.idx")
+    patterns = create_word_patterns("test_word_list.txt")
+    index = PatternIndex(filename)
+    result = True # start assuming test will pass
+    if not is_pattern_index(filename) or len(index) != len(patterns):
+        result = False # failed
+    for pattern in patterns:
+        if index[pattern] != sorted(patterns[pattern]):
+            result = False # failed
+    if sorted(index.keys()) != sorted(patterns) or "ABAB" in index:
+        result = False # failed
+    if index.get("ABAB", []) != [] or get_words_for_pattern("AB",
+      index) != ['am', 'do', 'go', 'to']:
+        result = False # failed
+    updated = remove_words(add_words(index, ['kiwi', 'lime']), ['more'])
+    if updated["ABCB"] != ['kiwi'] or updated["ABCD"] != ['lime']:
+        result = False # failed
+    if index["ABCD"] != ['more'] or PatternIndex(filename)["ABCB"] != ['kiwi']:
+        result = False # failed, old index must keep its words
+    index.close()
+    updated.close()
+    os.remove(filename)
+    return result
+
+
+def test_word_trie():
+    '''Test function query_words() and class WordTrie.'''
+    patterns = create_word_patterns("test_word_list.txt")
+    result = True # start assuming test will pass
+    if list(query_words("XYZ", {}, patterns)) != get_words_for_pattern("ABC",
+      patterns):
+        result = False # failed
+    # known letters
+    if list(query_words("XYZ", {'X' : 'c'}, patterns)) != ['can', 'car']:
+        result = False # failed
+    # plainchars taken by other cypherchars
+    if list(query_words("XYZ", {'Q' : 'c', 'R' : 'w', 'X' : 't'},
+      patterns)) != ['the']:
+        result = False # failed
+    # repeated letters in the cypher word
+    trie = WordTrie(['these', 'there', 'three', 'thine'])
+    if list(trie.query("ABCDC", {'B' : 'h'})) != ['there', 'these']:
+        result = False # failed
+    if list(query_words("QQQ", {}, patterns)) != []:
+        result = False # failed
+    return result
+
+
+def test_word_lists():
+    '''Test class WordLists.'''
+    wordlists = WordLists(cache_size=2)
+    wordlists.add(create_word_patterns("test_word_list.txt"),
+      {'the' : 50, 'and' : 30, 'can' : 5})
+    wordlists.add({"ABC" : ['bob', 'tom'], "ABB" : ['ann']}, weight=0.01)
+    result = True # start assuming test will pass
+    if wordlists["ABC"] != ['the', 'and', 'can', 'bin', 'car', 'eat', 'why',
+      'bob', 'tom']:
+        result = False # failed
+    if wordlists.candidates("ABC", [(0, 'c')]) != ['can', 'car']:
+        result = False # failed
+    if "ABB" not in wordlists or wordlists["ABB"] != ['add', 'ann']:
+        result = False # failed
+    if len(wordlists.cache) != 2 or ("ABC", ()) in wordlists.cache:
+        result = False # failed - least recently used entry not dropped
+    if get_position_index("ABC", wordlists).words != wordlists["ABC"]:
+        result = False # failed
+    return result
+
+
 def test_get_words_for_pattern():
     '''Test function get_words_for_pattern().'''
     result = True # start assuming test will pass
@@ -266,6 +1240,36 @@ def test_get_words_for_pattern():
     return result
 
 
+def test_default_patterns():
+    '''Test default_patterns() loading lazily from $CRYPTO_WORD_PATTERNS.'''
+    global _default_patterns
+    # importing must not read the pattern file, so a missing one is no error
+    env = dict(os.environ)
+    env[WORD_PATTERN_ENV] = "missing_word_patterns.json"
+    if subprocess.call([sys.executable, "-c", "import frequencies"],
+      env=env, cwd=os.path.dirname(os.path.abspath(__file__))) != 0:
+        return False # failed
+    filename = "patterns_env_test_word_list.json"
+    write_pattern_file(create_word_patterns("test_word_list.txt"), filename)
+    saved_env = os.environ.get(WORD_PATTERN_ENV)
+    saved_patterns = _default_patterns
+    result = True # start assuming test will pass
+    try:
+        os.environ[WORD_PATTERN_ENV] = filename
+        _default_patterns = None
+        if word_pattern_file() != filename or get_words_for_pattern("AB") != \
+          ['am', 'do', 'go', 'to'] or "ABCDEFGHIDGB" in default_patterns():
+            result = False # failed
+    finally:
+        if saved_env is None:
+            del os.environ[WORD_PATTERN_ENV]
+        else:
+            os.environ[WORD_PATTERN_ENV] = saved_env
+        _default_patterns = saved_patterns
+        os.remove(filename)
+    return result
+
+
 def test_refine_words():
     '''Test function filter_words()'''
     result = True # start assuming test will pass
@@ -290,19 +1294,51 @@ def test_refine_words():
     for word in expected:
         if not word in filtered_words:
             result = False # failed - word missing
+    # test adjacent words that both fail the second character
+    if filter_words(words, [0, 9], ['p', 't']) != ['pedicurist']:
+        result = False # failed
     return result
 
 
+def test_position_index():
+    '''Test class PositionIndex against filter_words().'''
+    words = ['pediatrics', 'pediculina', 'pedicurism', 'pedicurist']
+    index = PositionIndex(words)
+    for indexes, chars in [([1, 4], ['e', 'c']), (6, 'r'), ([0, 9], ['p', 't']),
+      ([2], ['x'])]:
+        if index.filter(indexes, chars) != filter_words(words, indexes, chars):
+            return False # failed
+    mask = index.exclude([9], ['a', 'm'], index.match([4], ['c']))
+    if index.select(mask) != ['pedicurist']:
+        return False # failed
+    if get_position_index("AB").select(get_position_index("AB").all) != \
+      get_words_for_pattern("AB"):
+        return False # failed
+    return True # passed
+
+
 def run_tests():
     '''Run all tests for this file.'''
     result = "passed" # start assuming tests will pass
     print("\n"+15*'=', "Testing module %s" % __file__, 15*'=')
     tests = [
       (test_get_pattern(),"Test get_pattern:"),
+      (test_letter_histogram(), "Test letter_histogram:"),
+      (test_adjacency_matrix(), "Test adjacency_matrix:"),
+      (test_scorers(), "Test chi_squared and log_likelihood:"),
+      (test_ngram_counter(), "Test NGramCounter:"),
+      (test_ngram_log_probabilities(), "Test ngram_histogram:"),
+      (test_ngram_model_file(), "Test build_quadgram_model:"),
       (test_create_word_patterns_list(), "Test create_word_patterns:"),
+      (test_add_remove_words(), "Test add_words and remove_words:"),
       (test_read_write(), "Test read_pattern_file and write_pattern_file:"),
+      (test_pattern_index(), "Test PatternIndex:"),
       (test_get_words_for_pattern(), "Test get_words_for_pattern:"),
-      (test_refine_words(), "Test refine_words:")
+      (test_default_patterns(), "Test default_patterns:"),
+      (test_word_trie(), "Test WordTrie:"),
+      (test_word_lists(), "Test WordLists:"),
+      (test_refine_words(), "Test refine_words:"),
+      (test_position_index(), "Test PositionIndex:"),
       ]
     for test in tests:
         this_result = "passed" if test[0] else "failed"